@@ -0,0 +1,401 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from numpy.random import default_rng
+from hmm import zscore
+from profiling import reset_peak, peak_mb
+from s_light import get_s_lights, run_searchlight, HMM_stats, \
+                    shift_corr_stats, get_vox_map
+from utils import hyperalign, heldout_ll_sweep, tj_fit, lag_pearsonr, \
+                  nearest_peak, FDR_p, get_perms, get_DTs, ev_annot_freq, \
+                  hrf_convolution
+
+# Problem sizes: 'full' matches the real analysis (30 subjects, 2mm MNI
+# mask, searchlights of radius 5), 'quick' is a smoke test
+SIZES = {'full': {'nSubj': 30, 'nVox': 500, 'nPerm': 3,
+                  'mask_shape': (91, 109, 91)},
+         'quick': {'nSubj': 8, 'nVox': 150, 'nPerm': 3,
+                   'mask_shape': (46, 55, 46)}}
+
+# Import time budget in seconds of the modules that each worker process
+# imports at startup (spawned workers import main again), and dependencies
+# that they must only import in the code paths that use them
+IMPORT_BUDGETS = {'main': 0.5, 'parallel': 0.5}
+HEAVY_MODULES = ['tables', 'nibabel', 'pandas', 'scipy', 'cv2', 'sklearn',
+                 'brainiak']
+
+
+def synthetic_mask(shape=(91, 109, 91), seed=0):
+    """Brain-shaped mask of valid voxels, with the size of the MNI template
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the volume (z/y/x)
+    seed : int
+        Seed of the random boundary
+
+    Returns
+    -------
+    ndarray
+        3d boolean mask: an ellipsoid filling most of the volume, with a
+        smoothly varying random boundary
+    """
+
+    rng = default_rng(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape],
+                       indexing='ij')
+    r = np.sqrt(sum((g / a)**2 for g, a in zip(grid, (0.85, 0.9, 0.8))))
+
+    # Low-frequency bumps on the boundary
+    bumps = sum(c * np.cos(np.pi * (f * g + ph)) for g, c, f, ph in
+                zip(grid, 0.05 * rng.standard_normal(3),
+                    rng.integers(1, 4, 3), rng.uniform(0, 2, 3)))
+    return r < 1 + bumps
+
+
+def synthetic_s_light(nSubj=30, nReps=6, nTR=60, nVox=500, n_events=7,
+                      anticipation=1, noise=2.0, seed=0):
+    """Searchlight data with event structure shared across subjects
+
+    Each subject sees the same sequence of n_events events, each with a
+    latent pattern that is projected into voxels through loadings shared by
+    all subjects plus subject-specific deviations, and Gaussian noise is
+    added. Event boundaries are jittered around an even spacing, and on
+    repeated viewings every boundary comes anticipation TRs earlier. The
+    data is z-scored in time, as in the searchlight store.
+
+    Parameters
+    ----------
+    nSubj : int
+        Number of subjects
+    nReps : int
+        Number of repetitions
+    nTR : int
+        Number of timepoints in each repetition
+    nVox : int
+        Number of voxels
+    n_events : int
+        Number of events
+    anticipation : int
+        Shift of the boundaries on repeated viewings, in TRs
+    noise : float
+        Standard deviation of the noise, relative to the signal
+    seed : int
+        Seed of the random generator
+
+    Returns
+    -------
+    list of ndarrays
+        List of Reps x TRs x Vox arrays for each subject
+    """
+
+    rng = default_rng(seed)
+    nFeatures = 10
+    bounds = np.round(np.linspace(0, nTR, n_events + 1)[1:-1] +
+                      rng.uniform(-2, 2, n_events - 1)).astype(int)
+    labels = np.array([np.searchsorted(bounds - (rep > 0) * anticipation,
+                                       np.arange(nTR), side='right')
+                       for rep in range(nReps)])
+    event_pat = rng.standard_normal((n_events, nFeatures))
+    shared_loadings = rng.standard_normal((nFeatures, nVox))
+
+    data_list = []
+    for _ in range(nSubj):
+        loadings = shared_loadings + rng.standard_normal((nFeatures, nVox))
+        d = event_pat[labels] @ loadings + \
+            noise * np.sqrt(nFeatures) * rng.standard_normal((nReps, nTR,
+                                                              nVox))
+        data_list.append(zscore(d, axis=1))
+    return data_list
+
+
+def checksum(out):
+    """Position-weighted sum of the absolute finite values of a result
+
+    The weights increase along the flattened result, so that results whose
+    values always have the same sum (e.g. segmentations) are still checked.
+    """
+
+    if isinstance(out, (list, tuple)):
+        return float(sum(checksum(o) for o in out))
+    out = np.abs(np.asarray(out, dtype=np.float64).ravel())
+    out[~np.isfinite(out)] = 0
+    return float(np.dot(out, np.linspace(1, 2, len(out))))
+
+
+def time_case(fn, n_items, unit, repeat=3):
+    """Time a benchmark case
+
+    Parameters
+    ----------
+    fn : function
+        Runs the case once and returns its result
+    n_items : int
+        Number of items (searchlights, models, ...) processed per run
+    unit : string
+        Name of the items
+    repeat : int
+        Number of runs
+
+    Returns
+    -------
+    dict
+        Best and mean wall time and CPU time in seconds, throughput (items
+        per second for the best run), peak RSS in MB during the case (on
+        Linux, otherwise the peak of the process so far), and checksum of
+        the result
+    """
+
+    wall = []
+    cpu = []
+    peak = 0.0
+    for _ in range(repeat):
+        reset_peak()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        out = fn()
+        wall.append(time.perf_counter() - start_wall)
+        cpu.append(time.process_time() - start_cpu)
+        peak = max(peak, peak_mb())
+    return {'seconds': min(wall), 'mean_seconds': float(np.mean(wall)),
+            'cpu_seconds': min(cpu),
+            'throughput': n_items / min(wall), 'unit': unit + '/s',
+            'peak_rss_mb': peak, 'checksum': checksum(out)}
+
+
+def import_time(module, repeat=3):
+    """Time importing a module in a fresh interpreter
+
+    Parameters
+    ----------
+    module : string
+        Module of this repository to import
+    repeat : int
+        Number of interpreters to time the import in
+
+    Returns
+    -------
+    dict
+        Best import time in seconds, and the modules of HEAVY_MODULES that
+        the import loaded
+    """
+
+    code = ('import sys, time\n'
+            't = time.perf_counter()\n'
+            'import %s\n'
+            'print(time.perf_counter() - t)\n'
+            'print(" ".join(m for m in %r if m in sys.modules))\n' %
+            (module, HEAVY_MODULES))
+    seconds = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE, check=True,
+                             universal_newlines=True).stdout.split('\n')
+        seconds.append(float(out[0]))
+    return {'seconds': min(seconds), 'heavy_modules': out[1].split()}
+
+
+def check_imports(imports, budgets=None):
+    """Find imports over their time budget or loading heavy dependencies
+
+    Parameters
+    ----------
+    imports : dict
+        Output of import_time for each module
+    budgets : dict, optional
+        Import time budget in seconds of each module (defaults to
+        IMPORT_BUDGETS)
+
+    Returns
+    -------
+    list of strings
+        Description of each violation (empty if there are none)
+    """
+
+    if budgets is None:
+        budgets = IMPORT_BUDGETS
+    violations = []
+    for module, imp in imports.items():
+        if imp['seconds'] > budgets[module]:
+            violations.append('import %s: %.3gs, over its budget of %.3gs' %
+                              (module, imp['seconds'], budgets[module]))
+        if imp['heavy_modules']:
+            violations.append('import %s: loads %s' %
+                              (module, ', '.join(imp['heavy_modules'])))
+    return violations
+
+
+def run_benchmarks(size='full', repeat=3, seed=0, cases=None):
+    """Time the hot paths of the analysis on synthetic data
+
+    Parameters
+    ----------
+    size : string
+        Problem size, a key of SIZES
+    repeat : int
+        Number of runs of each case (the best is reported)
+    seed : int
+        Seed of the synthetic data
+    cases : list of strings, optional
+        Cases to run (defaults to all)
+
+    Returns
+    -------
+    dict
+        Description of the machine and problem size ('meta'), results of
+        each case ('cases', see time_case), and import time of the modules
+        of IMPORT_BUDGETS ('imports', see import_time)
+    """
+
+    sizes = SIZES[size]
+    nSubj, nPerm = sizes['nSubj'], sizes['nPerm']
+    max_lag = 10
+    n_events = 7
+    K_range = np.arange(2, 10)
+
+    mask = synthetic_mask(sizes['mask_shape'], seed)
+    coords = np.transpose(np.where(mask))
+    data_list = synthetic_s_light(nSubj, nVox=sizes['nVox'], seed=seed)
+    subjects = ['sub-%02d' % s for s in range(nSubj)]
+    perms = get_perms(nSubj, nPerm)
+    split = np.arange(nSubj) < nSubj // 2
+    rng = default_rng(seed)
+
+    # Inputs of the later stages, from the earlier ones
+    SL_allvox = get_s_lights(coords)
+    shared = hyperalign(data_list, perms=perms)
+    group_data = np.array([np.mean(s, axis=0) for s in shared])
+    segs = tj_fit(group_data, n_events)
+    ev_conv = hrf_convolution(ev_annot_freq())
+    DTs = np.tile(get_DTs(segs), (len(SL_allvox), 1, 1, 1))
+    lag_corrs = lag_pearsonr(DTs, ev_conv[1:], max_lag)
+    pvals = rng.uniform(size=(4, len(coords)))**2
+    SL_results = rng.standard_normal((len(SL_allvox), 5, 100))
+
+    all_cases = {
+        'get_s_lights': (lambda: get_s_lights(coords),
+                         len(SL_allvox), 'searchlights'),
+        'hyperalign': (lambda: hyperalign(data_list, perms=perms),
+                       nPerm, 'perms'),
+        'heldout_ll_sweep': (lambda: heldout_ll_sweep(
+            np.array([d[0] for d in data_list]), K_range, split),
+                             2 * len(K_range), 'models'),
+        'tj_fit': (lambda: tj_fit(group_data, n_events), nPerm, 'models'),
+        'lag_pearsonr': (lambda: lag_pearsonr(DTs, ev_conv[1:], max_lag),
+                         DTs[..., 0].size, 'curves'),
+        'nearest_peak': (lambda: nearest_peak(lag_corrs),
+                         lag_corrs[..., 0].size, 'curves'),
+        'FDR_p': (lambda: FDR_p(pvals), pvals.size, 'p values'),
+        'get_vox_map': (lambda: get_vox_map(SL_results, SL_allvox, mask),
+                        SL_results[:, :, 0].size, 'maps'),
+        # All analyses of one searchlight, as run by each worker in main.py
+        'searchlight': (lambda: _searchlight(data_list, perms, subjects,
+                                             max_lag, ev_conv),
+                        1, 'searchlights'),
+    }
+
+    results = {}
+    for name in (cases or all_cases):
+        fn, n_items, unit = all_cases[name]
+        results[name] = time_case(fn, n_items, unit, repeat)
+        print('%s: %.3gs, %.3g %s/s' % (name, results[name]['seconds'],
+                                        results[name]['throughput'], unit),
+              file=sys.stderr)
+
+    meta = {'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'n_cpus': os.cpu_count(),
+            'size': size, 'seed': seed, 'repeat': repeat,
+            'n_vox_mask': len(coords), 'n_s_lights': len(SL_allvox)}
+    meta.update({k: v for k, v in sizes.items() if k != 'mask_shape'})
+    imports = {module: import_time(module, repeat)
+               for module in IMPORT_BUDGETS}
+    return {'meta': meta, 'cases': results, 'imports': imports}
+
+
+def _searchlight(data_list, perms, subjects, max_lag, ev_conv):
+    """Run all analyses of one searchlight and compute their statistics"""
+
+    results = run_searchlight(data_list, perms, subjects, max_lag)
+    AUCdiffs, peak_shift = HMM_stats(results['fit_HMM'], ev_conv, max_lag)
+    return [results['optimal_events'], AUCdiffs, peak_shift,
+            shift_corr_stats(results['shift_corr'], max_lag)]
+
+
+def compare_benchmarks(results, baseline, max_slowdown=1.5, rtol=1e-6):
+    """Find regressions of benchmark results relative to a baseline
+
+    Parameters
+    ----------
+    results : dict
+        Output of run_benchmarks
+    baseline : dict
+        Output of run_benchmarks to compare to
+    max_slowdown : float
+        Largest allowed ratio of wall time to the baseline
+    rtol : float
+        Relative tolerance of the result checksums
+
+    Returns
+    -------
+    list of strings
+        Description of each regression (empty if there are none)
+    """
+
+    regressions = []
+    if results['meta']['size'] != baseline['meta']['size'] or \
+       results['meta']['seed'] != baseline['meta']['seed']:
+        return ['baseline has a different size or seed']
+
+    for name, case in results['cases'].items():
+        if name not in baseline['cases']:
+            continue
+        base = baseline['cases'][name]
+        ratio = case['seconds'] / base['seconds']
+        if ratio > max_slowdown:
+            regressions.append('%s: %.2fx slower (%.3gs vs %.3gs)' %
+                               (name, ratio, case['seconds'],
+                                base['seconds']))
+        if not np.isclose(case['checksum'], base['checksum'], rtol=rtol,
+                          atol=0):
+            regressions.append('%s: result changed (checksum %r vs %r)' %
+                               (name, case['checksum'], base['checksum']))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Time the analysis on synthetic data')
+    parser.add_argument('--size', choices=sorted(SIZES), default='full')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cases', nargs='+',
+                        help='cases to run (defaults to all)')
+    parser.add_argument('--out', help='JSON file for the results '
+                        '(defaults to standard output)')
+    parser.add_argument('--baseline', help='JSON file of baseline results '
+                        'to compare to')
+    parser.add_argument('--max-slowdown', type=float, default=1.5)
+    args = parser.parse_args()
+
+    bench = run_benchmarks(args.size, args.repeat, args.seed, args.cases)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(bench, f, indent=1)
+    else:
+        print(json.dumps(bench, indent=1))
+
+    regressions = check_imports(bench['imports'])
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions += compare_benchmarks(bench, json.load(f),
+                                              args.max_slowdown)
+    for r in regressions:
+        print('REGRESSION ' + r, file=sys.stderr)
+    sys.exit(1 if regressions else 0)
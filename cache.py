@@ -0,0 +1,178 @@
+import hashlib
+import os
+import zipfile
+import numpy as np
+
+# Increase to invalidate all cached results when the analyses change
+CACHE_VERSION = 1
+
+# Number of stores by a process between scans of the cache for eviction
+EVICT_EVERY = 64
+_n_stores = 0
+
+
+def data_digest(data_list):
+    """Hash of the contents of a searchlight's data
+
+    Parameters
+    ----------
+    data_list : list of ndarrays
+        List of Reps x TRs x Vox arrays for each subject
+
+    Returns
+    -------
+    string
+        SHA-1 hex digest of the shapes, dtypes and values of all arrays
+    """
+
+    h = hashlib.sha1()
+    for d in data_list:
+        d = np.ascontiguousarray(d)
+        h.update(repr((d.shape, d.dtype.str)).encode())
+        h.update(d.data)
+    return h.hexdigest()
+
+
+def cache_key(digest, analysis, params):
+    """Key of the cache entry for one analysis of one searchlight's data
+
+    Parameters
+    ----------
+    digest : string
+        Hash of the searchlight data, from data_digest
+    analysis : string
+        Analysis name
+    params : dict
+        Parameters of the analysis (values must have a stable repr)
+
+    Returns
+    -------
+    string
+        SHA-1 hex digest of the version, data, analysis and parameters
+    """
+
+    return hashlib.sha1(repr((CACHE_VERSION, digest, analysis,
+                              sorted(params.items()))).encode()).hexdigest()
+
+
+def cache_load(cache_dir, key, perms):
+    """Look up cached results for a set of permutations
+
+    Each entry holds the results of one analysis of one searchlight for
+    every permutation computed so far, indexed by the permutation's rep
+    orders. A hit marks the entry as recently used.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Cache directory
+    key : string
+        Entry key, from cache_key
+    perms : ndarray
+        Rep orders of each permutation to look up
+
+    Returns
+    -------
+    list
+        Cached result for each permutation, or None if it is not cached
+    """
+
+    fname = os.path.join(cache_dir, key + '.npz')
+    try:
+        with np.load(fname) as entry:
+            cached_perms = entry['perms']
+            cached_results = entry['results']
+        os.utime(fname)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return len(perms) * [None]
+
+    rows = {p.tobytes(): i for i, p in enumerate(cached_perms)}
+    return [cached_results[rows[p.tobytes()]]
+            if p.tobytes() in rows else None
+            for p in np.asarray(perms, dtype=np.int64)]
+
+
+def cache_store(cache_dir, key, perms, results, max_bytes=2**30):
+    """Add results to the cache, evicting entries beyond max_bytes
+
+    New permutations are merged into the existing entry, which is replaced
+    atomically. Every EVICT_EVERY stores of a process, entries are evicted
+    in order of least recent use (file modification time) until the cache
+    is no larger than max_bytes, so that the directory is not scanned on
+    every store. In between, the cache can grow beyond max_bytes by the
+    entries stored since the last eviction of each process.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Cache directory
+    key : string
+        Entry key, from cache_key
+    perms : ndarray
+        Rep orders of each permutation
+    results : ndarray
+        Results for each permutation
+    max_bytes : int
+        Maximum total size of the cache
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fname = os.path.join(cache_dir, key + '.npz')
+    perms = np.asarray(perms, dtype=np.int64)
+    results = np.asarray(results)
+
+    try:
+        with np.load(fname) as entry:
+            cached_perms = entry['perms']
+            cached_results = entry['results']
+        new = ~np.isin([p.tobytes() for p in perms],
+                       [p.tobytes() for p in cached_perms])
+        perms = np.concatenate((cached_perms, perms[new]))
+        results = np.concatenate((cached_results, results[new]))
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        pass
+
+    tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp_fname, 'wb') as f:
+        np.savez(f, perms=perms, results=results)
+    os.replace(tmp_fname, fname)
+
+    global _n_stores
+    _n_stores += 1
+    if _n_stores % EVICT_EVERY == 0:
+        evict(cache_dir, max_bytes, keep=fname)
+
+
+def evict(cache_dir, max_bytes, keep=None):
+    """Remove least recently used entries until the cache fits in max_bytes
+
+    Parameters
+    ----------
+    cache_dir : string
+        Cache directory
+    max_bytes : int
+        Maximum total size of the cache
+    keep : string, optional
+        Entry that is never evicted
+    """
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npz'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -1,18 +1,17 @@
 import glob
+import hashlib
 import pickle
-import tables
 import numpy as np
-import pandas as pd
-import pandas as pd
-import nibabel as nib
 import os
+from concurrent.futures import ProcessPoolExecutor
 from s_light import get_s_lights
 from utils import save_nii, save_clip_nii
 
-def scans_to_clips(fpath, subjects):
+def scans_to_clips(fpath, subjects, n_jobs=None, compress=True):
     """Splits each subject scan into clips based on their tsv file and writes out these as nii images.
 
     There is total of 6 clips per scans. 2 intact (IN), 2 scrambled fixed (SF), 2 scrambled random (SR). 
+    Runs are processed in parallel by a pool of worker processes.
 
     Parameters
     ----------
@@ -20,25 +19,63 @@ def scans_to_clips(fpath, subjects):
         Path to data directory
     subjects : list
         List of subjects to process
+    n_jobs : int, optional
+        Number of worker processes (defaults to the number of CPUs)
+    compress : boolean, optional
+        Whether to save gzipped clips or uncompressed, memory mappable clips
 
     """
+    fnames = []
+    tsv_fpaths = []
     for subj in subjects:
         for run in os.listdir(subj):
             if 'func_brain.nii.gz' in run:
                 print('Processing ' + run)
                 sub_id = run[run.find('sub'):run.find('sub')+6] # this takes subj and returns sub-01, etc
-                fname = fpath + 'pre_outputs/' + sub_id + '/' + run # preprocessed functional file
+                fnames.append(fpath + 'pre_outputs/' + sub_id + '/' + run) # preprocessed functional file
                 run_str = run[run.find('run'):run.find('run')+6] # this takes subj and returns sub-01, etc
-                tsv_fpath = fpath + 'raw_data/{}/func/{}_task-movie_{}_events.tsv'.format(sub_id, sub_id, run_str)
-                save_clip_nii(fname, tsv_fpath) # this is added to divide clips before the analysis
+                tsv_fpaths.append(fpath + 'raw_data/{}/func/{}_task-movie_{}_events.tsv'.format(sub_id, sub_id, run_str))
 
+    # this is added to divide clips before the analysis
+    with ProcessPoolExecutor(n_jobs) as pool:
+        list(pool.map(save_clip_nii, fnames, tsv_fpaths,
+                      len(fnames) * ['All'], len(fnames) * [compress]))
 
-def find_valid_vox(fpath, subjects, min_subjs=15):
+def _find_clip(subj, cond, rep):
+    """Find the clip files for a subject, condition and rep
+
+    Uncompressed clips are preferred over gzipped ones if both exist.
+
+    Parameters
+    ----------
+    subj : string
+        Subject directory
+    cond : string
+        Condition of the clip ('IN', 'SF' or 'SR')
+    rep : int
+        Repetition number, starting at 1
+
+    Returns
+    -------
+    list
+        Matching file names
+    """
+
+    pattern = subj + '/*' + cond + '*' + str(rep)
+    return glob.glob(pattern + '.nii') or glob.glob(pattern + '.nii.gz')
+
+
+def find_valid_vox(fpath, subjects, min_subjs=15, n_jobs=None,
+                   cache_dir=None):
     """Loads data files to define valid_vox.nii
 
     Finds voxels that have data from at least min_subjs valid subjects and
     intersect with an MNI brain mask.
 
+    Each clip is read once by a pool of worker processes, which mark the
+    voxels with nonzero variance. The per-file masks are cached in
+    cache_dir, so only new or modified files are read on later runs.
+
     Parameters
     ----------
     fpath : string
@@ -47,36 +84,39 @@ def find_valid_vox(fpath, subjects, min_subjs=15):
         List of subjects to use
     min_subjs : int, optional
         Minimum number of subjects for a valid voxel
+    n_jobs : int, optional
+        Number of worker processes (defaults to the number of CPUs)
+    cache_dir : string, optional
+        Directory for per-file mask caches (defaults to fpath/valid_vox_cache/)
     """
 
-    D_num_not_nan = []
+    import nibabel as nib
+
     MNI_path = 'MNI152_T1_brain_resample.nii'
-    print("Loading data", end='', flush=True)
+    if cache_dir is None:
+        cache_dir = fpath + 'valid_vox_cache/'
+    os.makedirs(cache_dir, exist_ok=True)
+
+    fnames = []
     for rep in range(6):
-        # D_rep = np.zeros((121, 145, 121, 60))
-        D_not_nan = np.zeros((121, 145, 121))
         for subj in subjects:
-            print('.', end='', flush=True)
-            fname = glob.glob(subj + '/*IN*' +
-                            str(rep + 1) + '.nii.gz')
+            fname = _find_clip(subj, 'IN', rep + 1)
 
             assert len(fname) == 1, \
                     "More than one file found for subject " + subj
-            
-            print(fname[0])
-
-            rep_z = nib.load(fname[0]).get_fdata()
-            # nnan = ~np.all(rep_z == 0, axis=3) 
-            nnan = ~np.squeeze(np.std(rep_z, axis=3, keepdims=True) == 0) # find voxels with std == 0
-            # nnan = ~np.all(rep_z <= np.percentile(rep_z, 10), axis=3) 
-            # rep_mean = np.mean(rep_z[nnan], axis=1, keepdims=True) # mean for each voxel
-            # rep_std = np.std(rep_z[nnan], axis=1, keepdims=True) # std for each voxel
-            # rep_z[nnan] = (rep_z[nnan] - rep_mean)/rep_std
+            fnames.append(fname[0])
 
-            # D_rep[nnan] += rep_z[nnan]
-            D_not_nan[nnan] += 1
-
-        D_num_not_nan.append(D_not_nan.T)
+    print("Loading data", end='', flush=True)
+    D_num_not_nan = []
+    with ProcessPoolExecutor(n_jobs) as pool:
+        nnan_masks = pool.map(_nonzero_var_vox, fnames,
+                              len(fnames) * [cache_dir])
+        for rep in range(6):
+            D_not_nan = 0
+            for _ in subjects:
+                print('.', end='', flush=True)
+                D_not_nan = D_not_nan + next(nnan_masks)
+            D_num_not_nan.append(D_not_nan.T)
     print(' ')
 
     non_nan_mask = np.min(D_num_not_nan, axis=0) # Min across reps
@@ -85,12 +125,87 @@ def find_valid_vox(fpath, subjects, min_subjs=15):
 
     save_nii(fpath + 'valid_vox.nii', MNI_path, non_nan_mask)
 
-def save_s_lights(fpath, non_nan_mask, savepath):
-    """Save a separate data file for each searchlight
-    
-    Load subject data and divide into a separate file for each searchlight.
-    This is helpful for parallelizing searchlight analyses in a cluster.
-    
+def _nonzero_var_vox(fname, cache_dir, max_mem=2**28):
+    """Find voxels with nonzero variance over time in one 4d file
+
+    The file is read once through its array proxy in chunks of volumes, in
+    its stored dtype, and a voxel has nonzero variance if its running
+    minimum and maximum over time differ. The resulting mask is cached in
+    cache_dir as packed bits, keyed by the file path, size and modification
+    time.
+
+    Parameters
+    ----------
+    fname : string
+        Path to 4d nii file
+    cache_dir : string
+        Directory for the mask cache
+    max_mem : int, optional
+        Memory ceiling in bytes for each chunk of volumes
+
+    Returns
+    -------
+    ndarray
+        3d boolean mask (x/y/z) of voxels with nonzero variance
+    """
+
+    import nibabel as nib
+
+    stat = os.stat(fname)
+    cache_fname = os.path.join(cache_dir, hashlib.sha1(
+        os.path.abspath(fname).encode()).hexdigest() + '.npz')
+    if os.path.exists(cache_fname):
+        cache = np.load(cache_fname)
+        if cache['mtime'] == stat.st_mtime and cache['size'] == stat.st_size:
+            shape = tuple(cache['shape'])
+            return np.unpackbits(cache['bits'],
+                                 count=np.prod(shape)).reshape(shape) > 0
+
+    # Volumes are read in order from a file that is kept open, so that a
+    # compressed file is decompressed once
+    img = nib.load(fname, keep_file_open=True)
+    vol_bytes = np.prod(img.shape[:3]) * img.get_data_dtype().itemsize
+    nt = max(1, int(max_mem // vol_bytes))
+
+    vox_min = vox_max = None
+    for t0 in range(0, img.shape[3], nt):
+        vols = np.asanyarray(img.dataobj[..., t0:(t0 + nt)])
+        if vox_min is None:
+            vox_min, vox_max = vols.min(axis=3), vols.max(axis=3)
+        else:
+            # np.minimum and np.maximum propagate nan, like min and max
+            np.minimum(vox_min, vols.min(axis=3), out=vox_min)
+            np.maximum(vox_max, vols.max(axis=3), out=vox_max)
+    # nan voxels stay valid, as with the std == 0 test
+    nnan = ~(vox_min == vox_max)
+
+    np.savez(cache_fname, mtime=stat.st_mtime, size=stat.st_size,
+             shape=nnan.shape, bits=np.packbits(nnan))
+    return nnan
+
+def save_s_lights(fpath, non_nan_mask, savepath, max_mem=None, dtype=None):
+    """Save all searchlight data into a single HDF5 store
+
+    Load subject data and write each subject's z-scored voxel time series
+    once into savepath/SL.h5, together with a table of the voxels in each
+    searchlight. Any searchlight can then be read with load_s_light, which
+    is helpful for parallelizing searchlight analyses in a cluster.
+
+    The store contains one chunked array per condition ('/IN', '/SF', '/SR')
+    with shape Subj x Vox x Reps x TRs, the subject names ('/subjects') and
+    the searchlight voxel table as concatenated voxel indices ('/SL_vox')
+    with offsets ('/SL_ptr'), so that searchlight i contains voxels
+    SL_vox[SL_ptr[i]:SL_ptr[i+1]].
+
+    By default each rep is loaded in full and z-scored in float64, or in
+    float32 if dtype is np.float32, which halves the memory, the size of the
+    store and the bandwidth of every searchlight load (all analyses then run
+    in float32). If max_mem is given, each file is instead streamed through
+    its nibabel array proxy in chunks of volumes, in two sequential passes
+    over a file that is kept open, z-scored and written straight into the
+    store in float32, so that no more than max_mem bytes of image data are
+    held at once.
+
     Parameters
     ----------
     fpath : string
@@ -99,25 +214,61 @@ def save_s_lights(fpath, non_nan_mask, savepath):
         3d boolean mask of valid voxels
     savepath : string
         Path to directory to save data files
+    max_mem : int, optional
+        Memory ceiling in bytes for the streaming float32 mode
+    dtype : dtype, optional
+        np.float64 or np.float32 (defaults to float64, or float32 when
+        streaming)
     """
 
+    import nibabel as nib
+    import tables
+
     subjects = glob.glob(fpath + '*sub*')
     coords = np.transpose(np.where(non_nan_mask))
     SL_allvox = get_s_lights(coords) # returns indices of coordinates in a searchlight
     pickle.dump(SL_allvox, open(savepath + 'SL_allvox.p', 'wb')) # you need to have the right version of python to open it
-    nSL = len(SL_allvox)
+    nVox = coords.shape[0]
+    if dtype is None:
+        dtype = np.float64 if max_mem is None else np.float32
+    atom = tables.Atom.from_dtype(np.dtype(dtype))
 
-    for subj in subjects:
+    # Write under a temporary name, so that the store only appears once it
+    # is complete, and processes reading an older store keep their copy
+    tmp_fname = savepath + 'SL.h5.%d.tmp' % os.getpid()
+    h5file = tables.open_file(tmp_fname, mode='w')
+    h5file.create_array('/', 'subjects',
+                        np.array(['subj_' + subj.split('/')[-1]
+                                  for subj in subjects], dtype=bytes))
+    h5file.create_array('/', 'SL_ptr', np.cumsum(
+        [0] + [len(sl) for sl in SL_allvox], dtype=np.int64))
+    h5file.create_array('/', 'SL_vox',
+                        np.concatenate(SL_allvox).astype(np.int64))
+
+    for s, subj in enumerate(subjects):
         subjname = 'subj_' + subj.split('/')[-1]
         print(subjname)
         for cond in ['IN', 'SF', 'SR']:
             print("   " + cond)
+            if max_mem is not None:
+                for i in range(6):
+                    fname = _find_clip(subj, cond, i + 1)
+                    img = nib.load(fname[0], keep_file_open=True)
+                    if '/' + cond not in h5file:
+                        h5file.create_carray('/', cond, atom,
+                                             (len(subjects), nVox, 6,
+                                              img.shape[3]),
+                                             chunkshape=(1, 8, 6,
+                                                         img.shape[3]))
+                    _zscore_stream(img, non_nan_mask,
+                                   h5file.get_node('/', cond), s, i, max_mem)
+                continue
+
             all_rep = []
             for i in range(6):
                 # Load and z-score data
-                fname = glob.glob(subj + '/*' +
-                                cond + '*' + str(rep + 1) + '.nii.gz')
-                rep_z = nib.load(fname[0]).get_fdata().T
+                fname = _find_clip(subj, cond, i + 1)
+                rep_z = nib.load(fname[0]).get_fdata(dtype=dtype).T
                 rep_z = rep_z[:, non_nan_mask]
 
                 nnan = ~np.squeeze(np.std(rep_z, axis=0, keepdims=True) == 0) # find voxels with std == 0
@@ -135,15 +286,102 @@ def save_s_lights(fpath, non_nan_mask, savepath):
                 # new_img = nib.Nifti1Image(img.T, data.affine, data.header)
                 # nib.save(new_img, '/media/bayrakrg/digbata2/anticipation/pre_outputs/test.nii')
 
-            # Append to SL hdf5 files
-            for sl_i in range(nSL):
-                sl_data = np.zeros((6, 60, len(SL_allvox[sl_i])))
-                for rep in range(6):
-                    sl_data[rep,:,:] = all_rep[rep][:,SL_allvox[sl_i]]
-                h5file = tables.open_file(savepath + str(sl_i) + '.h5',
-                                        mode='a')
-
-                if '/' + subjname not in h5file:
-                    h5file.create_group('/', subjname)
-                h5file.create_array('/' + subjname, cond, sl_data)
-                h5file.close()
\ No newline at end of file
+            # Write all voxels of this subject and condition in one block,
+            # chunked along voxels so searchlights can be read by index
+            all_rep = np.stack(all_rep).transpose(2, 0, 1) # Vox x Reps x TRs
+            if '/' + cond not in h5file:
+                h5file.create_carray('/', cond, atom,
+                                     (len(subjects), nVox) + all_rep.shape[1:],
+                                     chunkshape=(1, 8) + all_rep.shape[1:])
+            h5file.get_node('/', cond)[s] = all_rep
+    h5file.close()
+    os.replace(tmp_fname, savepath + 'SL.h5')
+
+def _zscore_stream(img, non_nan_mask, out, subj_i, rep_i, max_mem):
+    """Z-score one rep in chunks of volumes and write it into the store
+
+    The file is read in two sequential passes over chunks of volumes, so
+    a compressed file is decompressed twice in total, whatever max_mem is.
+    The first pass accumulates the sums of each voxel (relative to its
+    first volume, for accuracy), and the second normalizes each chunk and
+    writes it into the store.
+
+    Parameters
+    ----------
+    img : nibabel image
+        Lazily loaded 4d clip, loaded with keep_file_open=True
+    non_nan_mask : ndarray
+        3d boolean mask of valid voxels (transposed to z/y/x)
+    out : tables.CArray
+        Subj x Vox x Reps x TRs array to write into
+    subj_i : int
+        Subject row of out
+    rep_i : int
+        Rep of out
+    max_mem : int
+        Memory ceiling in bytes for each chunk of volumes
+    """
+
+    # Bytes for one volume, read in its stored dtype and copied to float64
+    vol_bytes = np.prod(img.shape[:3]) * (img.get_data_dtype().itemsize + 8)
+    nt = max(1, int(max_mem // vol_bytes))
+    nTR = img.shape[3]
+
+    def chunks():
+        for t0 in range(0, nTR, nt):
+            vols = np.asanyarray(img.dataobj[..., t0:(t0 + nt)]).T
+            yield t0, vols[:, non_nan_mask].astype(np.float64)
+
+    first = None
+    dev_sum = 0
+    dev_sq = 0
+    for t0, rep in chunks():
+        if first is None:
+            first = rep[0].copy()
+        rep -= first
+        dev_sum = dev_sum + rep.sum(axis=0)
+        dev_sq = dev_sq + (rep * rep).sum(axis=0)
+
+    rep_mean = first + dev_sum / nTR
+    rep_std = np.sqrt(np.maximum(dev_sq / nTR - (dev_sum / nTR)**2, 0))
+    nnan = rep_std != 0 # find voxels with std == 0
+
+    for t0, rep in chunks():
+        rep[:, nnan] = (rep[:, nnan] - rep_mean[nnan]) / rep_std[nnan]
+        out[subj_i, :, rep_i, t0:(t0 + len(rep))] = \
+            rep.T.astype(np.float32)
+
+def load_s_light(h5file, sl_i, subjects, cond='IN'):
+    """Load one searchlight from the store written by save_s_lights
+
+    Parameters
+    ----------
+    h5file : tables.File or dict
+        Open searchlight store (SL.h5), or its arrays published in shared
+        memory, from shared.open_store
+    sl_i : int
+        Index of the searchlight
+    subjects : list
+        List of subject directories to load, in the order to return them
+    cond : string, optional
+        Condition to load ('IN', 'SF' or 'SR')
+
+    Returns
+    -------
+    list of ndarrays
+        List of Reps x TRs x Vox arrays for each subject
+    """
+
+    if isinstance(h5file, dict):
+        arrays = h5file
+    else:
+        arrays = {name: h5file.get_node('/', name)
+                  for name in ['SL_ptr', 'SL_vox', 'subjects', cond]}
+
+    SL_ptr = arrays['SL_ptr'][sl_i:sl_i + 2]
+    SL_vox = arrays['SL_vox'][SL_ptr[0]:SL_ptr[1]]
+    names = [n.decode() for n in arrays['subjects'][:]]
+    rows = [names.index('subj_' + subj.split('/')[-1]) for subj in subjects]
+
+    sl_data = arrays[cond][:, SL_vox] # Subj x Vox x Reps x TRs
+    return [sl_data[r].transpose(1, 2, 0) for r in rows]
@@ -0,0 +1,315 @@
+import numpy as np
+
+
+def zscore(a, axis=0, ddof=0):
+    """Z-score an array along an axis, as scipy.stats.zscore
+
+    Gives the same values as scipy.stats.zscore (NaN for constant slices),
+    without importing scipy.stats, which dominates the import time of the
+    worker processes.
+
+    Parameters
+    ----------
+    a : ndarray
+        Array to z-score
+    axis : int
+        Axis to z-score along
+    ddof : int
+        Degrees of freedom correction of the standard deviation
+
+    Returns
+    -------
+    ndarray
+        Z-scored array, float32 for float32 input and float64 otherwise
+    """
+
+    a = np.asarray(a)
+    if not np.issubdtype(a.dtype, np.inexact):
+        a = a.astype(np.float64)
+    n = a.shape[axis]
+    mn = a.mean(axis=axis, keepdims=True)
+    dev = a - mn
+    factor = n / (n - ddof) if n > ddof else np.nan
+    std = (np.mean(dev * dev, axis=axis, keepdims=True) * factor)**0.5
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = dev / std
+    z[np.broadcast_to(std <= np.abs(np.finfo(z.dtype).eps * mn),
+                      z.shape)] = np.nan
+    return z
+
+
+def default_var_schedule(step):
+    """Event variance at each fitting step, as in EventSegment"""
+
+    return 4 * (0.98 ** (step - 1))
+
+
+def logprob_obs(data, mean_pat, var):
+    """Log probability of observing each timepoint under each event model
+
+    Batched version of the Gaussian observation model of EventSegment: data
+    and event patterns are z-scored in space, so that the Gaussians measure
+    Pearson correlations, and the log probabilities are divided by the
+    number of voxels.
+
+    Parameters
+    ----------
+    data : ndarray
+        ... x TRs x Voxels data for each model
+    mean_pat : ndarray
+        ... x Voxels x Events centers of the Gaussians for each model
+    var : float or ndarray
+        Variance of the Gaussians, for all models or for each model
+
+    Returns
+    -------
+    ndarray
+        ... x TRs x Events log probability of each timepoint under each event
+    """
+
+    n_vox = data.shape[-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        data_z = zscore(data, axis=-1, ddof=1)
+        mean_pat_z = zscore(mean_pat, axis=-2, ddof=1)
+
+    # Squared distance between every timepoint and every event pattern
+    sq_dist = np.sum(data_z**2, axis=-1)[..., np.newaxis] + \
+              np.sum(mean_pat_z**2, axis=-2)[..., np.newaxis, :] - \
+              2 * (data_z @ mean_pat_z)
+    var = np.asarray(var, dtype=data.dtype)[..., np.newaxis, np.newaxis]
+
+    return (-0.5 * n_vox * np.log(2 * np.pi * var) -
+            0.5 * sq_dist / var) / n_vox
+
+
+def forward_backward(logprob, n_events):
+    """Run forward-backward on a batch of left-to-right event models
+
+    Each model goes through its events in order and then into a final sink
+    state, with the same transition probabilities as EventSegment: every
+    event is left with probability (n_events - 1) / TRs at each timepoint,
+    and the last event must be reached by the final timepoint. Models with
+    fewer events than the last axis of logprob ignore the extra columns.
+
+    Parameters
+    ----------
+    logprob : ndarray
+        ... x TRs x Events log probability of each timepoint under each event
+    n_events : int or ndarray
+        Number of events of all models, or of each model
+
+    Returns
+    -------
+    ndarray
+        ... x TRs x Events log probability of each timepoint belonging to
+        each event (-inf for events beyond n_events)
+
+    ndarray
+        Log-likelihood of each model
+    """
+
+    batch_shape = logprob.shape[:-2]
+    t, max_events = logprob.shape[-2:]
+    dtype = logprob.dtype
+    n_events = np.broadcast_to(n_events, batch_shape).ravel()
+    nModels = len(n_events)
+    models = np.arange(nModels)
+
+    # Add the sink state, and remove events beyond n_events
+    logprob = logprob.reshape(nModels, t, max_events)
+    real = np.arange(max_events) < n_events[:, np.newaxis]
+    logprob = np.concatenate((np.where(real[:, np.newaxis, :], logprob,
+                                       -np.inf),
+                              np.full((nModels, t, 1), -np.inf, dtype=dtype)),
+                             axis=2)
+
+    # Set up transition matrices, with final sink state
+    p_trans = (n_events - 1) / t
+    if np.any(p_trans >= 1):
+        raise ValueError('Too few timepoints')
+    P = np.zeros((nModels, max_events + 1, max_events + 1), dtype=dtype)
+    for k in range(max_events):
+        P[real[:, k], k, k] = 1 - p_trans[real[:, k]]
+        P[real[:, k], k, k + 1] = p_trans[real[:, k]]
+    P[models, n_events - 1, n_events] = 0
+    P[models, n_events - 1, -1] = p_trans
+    P[:, -1, -1] = 1
+    p_start = np.zeros((nModels, max_events + 1), dtype=dtype)
+    p_start[:, 0] = 1
+    p_end = np.zeros((nModels, max_events + 1), dtype=dtype)
+    p_end[models, n_events - 1] = 1
+
+    log_scale = np.zeros((nModels, t), dtype=dtype)
+    log_alpha = np.zeros((nModels, t, max_events + 1), dtype=dtype)
+    log_beta = np.zeros((nModels, t, max_events + 1), dtype=dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_p_start = np.log(p_start)
+        log_p_end = np.log(p_end)
+
+        # Forward pass
+        for i in range(t):
+            if i == 0:
+                log_alpha[:, 0] = log_p_start + logprob[:, 0]
+            else:
+                log_alpha[:, i] = np.log(np.einsum(
+                    'mk,mkj->mj', np.exp(log_alpha[:, i - 1]), P)) + \
+                    logprob[:, i]
+
+            log_scale[:, i] = np.logaddexp.reduce(log_alpha[:, i], axis=1)
+            log_alpha[:, i] -= log_scale[:, i, np.newaxis]
+
+        # Backward pass
+        log_beta[:, -1] = log_p_end - log_scale[:, -1, np.newaxis]
+        for i in reversed(range(t - 1)):
+            obs_weighted = log_beta[:, i + 1] + logprob[:, i + 1]
+            offset = np.max(obs_weighted, axis=1, keepdims=True)
+            log_beta[:, i] = offset + np.log(np.einsum(
+                'mk,mjk->mj', np.exp(obs_weighted - offset), P)) - \
+                log_scale[:, i, np.newaxis]
+
+        # Combine and normalize
+        log_gamma = log_alpha + log_beta
+        log_gamma -= np.logaddexp.reduce(log_gamma, axis=2, keepdims=True)
+
+        ll = np.sum(log_scale[:, :(t - 1)], axis=1) + np.logaddexp.reduce(
+            log_alpha[:, -1] + log_scale[:, -1, np.newaxis] + log_p_end,
+            axis=1)
+
+    log_gamma = log_gamma[:, :, :-1]
+    return log_gamma.reshape(batch_shape + (t, max_events)), \
+           ll.reshape(batch_shape)
+
+
+def fit_events(X, n_events, n_iter=500, step_var=default_var_schedule,
+               init_seg=None):
+    """Fit a batch of event segmentation models
+
+    Each model is fit as in EventSegment.fit, jointly to all of its datasets
+    (which share event patterns): the data is z-scored in time, and at each
+    step the event patterns are the segmentation-weighted means of the data,
+    the variance follows step_var, and fitting stops once the mean
+    log-likelihood decreases. All models are stepped together with batched
+    forward-backward passes, and each stops on its own. Float32 data is fit
+    in float32, and any other data in float64.
+
+    Parameters
+    ----------
+    X : ndarray
+        Models x Datasets x TRs x Voxels data
+    n_events : int or ndarray
+        Number of events of all models, or of each model
+    n_iter : int
+        Maximum number of fitting steps
+    step_var : function
+        Event variance at each step (starting at 1)
+    init_seg : ndarray, optional
+        Models x Datasets x TRs x Events initial segmentations (defaults to
+        uniform, as in EventSegment)
+
+    Returns
+    -------
+    ndarray
+        Models x Datasets x TRs x Events segmentations, with zero probability
+        for events beyond the number of events of each model
+
+    ndarray
+        Models x Voxels x Events learned event patterns
+
+    ndarray
+        Event variance of each model at the end of fitting
+    """
+
+    X = np.asarray(X)
+    dtype = X.dtype if X.dtype == np.float32 else np.float64
+    X = X.astype(dtype, copy=False)
+    nModels, nData, t, n_vox = X.shape
+    n_events = np.broadcast_to(n_events, (nModels,))
+    max_events = np.max(n_events)
+    real = (np.arange(max_events) < n_events[:, np.newaxis])
+    real = real[:, np.newaxis, np.newaxis, :]
+
+    # z-score in time
+    X = zscore(X, axis=2, ddof=1)
+    X_T = np.swapaxes(X, 2, 3)
+
+    if init_seg is None:
+        log_gamma = np.where(real, 0.0, -np.inf).astype(dtype) * \
+                    np.ones((nModels, nData, t, max_events), dtype=dtype)
+    else:
+        with np.errstate(divide='ignore'):
+            log_gamma = np.log(np.where(real, init_seg, 0)).astype(dtype)
+
+    segments = np.zeros((nModels, nData, t, max_events), dtype=dtype)
+    event_pat = np.zeros((nModels, n_vox, max_events), dtype=dtype)
+    event_var = np.zeros(nModels)
+    best_ll = np.full(nModels, -np.inf)
+
+    active = np.arange(nModels)
+    step = 1
+    while step <= n_iter and len(active) > 0:
+        iteration_var = step_var(step)
+
+        # Based on the current segmentation, compute the mean pattern for
+        # each event
+        seg_prob = np.exp(log_gamma[active])
+        with np.errstate(invalid='ignore'):
+            seg_prob = np.where(real[active], seg_prob /
+                                np.sum(seg_prob, axis=2, keepdims=True), 0)
+        mean_pat = np.mean(X_T[active] @ seg_prob, axis=1)
+
+        # Based on the current mean patterns, compute the event segmentation
+        logprob = logprob_obs(X[active], mean_pat[:, np.newaxis],
+                              iteration_var)
+        step_log_gamma, ll = forward_backward(
+            logprob, n_events[active, np.newaxis])
+
+        # Models whose log-likelihood has started decreasing undo this step
+        # and stop
+        mean_ll = np.mean(ll, axis=1)
+        keep = ~(mean_ll < best_ll[active])
+        active = active[keep]
+
+        log_gamma[active] = step_log_gamma[keep]
+        segments[active] = np.exp(step_log_gamma[keep])
+        event_var[active] = iteration_var
+        event_pat[active] = mean_pat[keep]
+        best_ll[active] = mean_ll[keep]
+        step += 1
+
+    return segments, event_pat, event_var
+
+
+def find_events(X, event_pat, event_var, n_events):
+    """Segment new data with learned event patterns
+
+    Batched version of EventSegment.find_events (the data is not z-scored
+    in time). Float32 data is segmented in float32, and any other data in
+    float64.
+
+    Parameters
+    ----------
+    X : ndarray
+        ... x TRs x Voxels testing data for each model
+    event_pat : ndarray
+        ... x Voxels x Events event patterns, from fit_events
+    event_var : float or ndarray
+        Event variance, for all models or for each model
+    n_events : int or ndarray
+        Number of events of all models, or of each model
+
+    Returns
+    -------
+    ndarray
+        ... x TRs x Events segmentations
+
+    ndarray
+        Log-likelihood of each model
+    """
+
+    X = np.asarray(X)
+    X = X.astype(X.dtype if X.dtype == np.float32 else np.float64,
+                 copy=False)
+    logprob = logprob_obs(X, event_pat.astype(X.dtype, copy=False),
+                          event_var)
+    log_gamma, ll = forward_backward(logprob, n_events)
+    return np.exp(log_gamma), ll
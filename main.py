@@ -1,95 +1,113 @@
 import glob
 import pickle
-import tables
-import nibabel as nib
 import numpy as np
 import sys
-from numpy.random import default_rng
 from data import find_valid_vox, save_s_lights, scans_to_clips
-from s_light import optimal_events, compile_optimal_events, \
-                    fit_HMM, compile_fit_HMM, \
-                    shift_corr, compile_shift_corr
+from s_light import compile_optimal_events, compile_fit_HMM, \
+                    compile_shift_corr
+from parallel import run_s_lights, shard_s_lights
+from results import merge_results
+from validate import validate_float32
 
-nSL = 5247 # 5354 # ??
 nPerm = 3 #100
 max_lag = 10
+n_jobs = None # worker processes per node, defaults to the number of CPUs
+batch_size = None # set to run permutations in batches, stopping each
+                  # searchlight early once its p values are decided
+dtype = np.float64 # np.float32 halves the size of the data store, and runs
+                   # all analyses in float32
+cache_dir = None # set to e.g. fpath + 'cache/' to cache analysis results, so
+                 # that only changed analyses and new permutations are rerun
+cache_size = 2**34 # bytes of analysis results to keep in the cache
+profile_path = None # set to a file, e.g. fpath + 'out/profile.jsonl', to log
+                    # the cost of each stage (python profiling.py <file>)
+shared_dir = None # set to e.g. '/dev/shm/anticipation/' to share one copy of
+                  # the searchlight data between the workers of each node
 
 fpath = '/media/bayrakrg/digbata2/anticipation/'
 header_fpath = 'MNI152_T1_brain_resample.nii'
 subjects = glob.glob(fpath + 'pre_outputs/*sub*')
 
-
-############################
-#       ONE TIME RUN       #
-############################
-
-# Save clips to save time during the analysis
-scans_to_clips(fpath, subjects)
-
-# # Create valid_vox.nii mask
-find_valid_vox(fpath + 'pre_outputs/', subjects)
-
-# Create a separate data file for each searchlight
-non_nan = nib.load(fpath + 'pre_outputs/valid_vox.nii').get_fdata().T > 0
-save_s_lights(fpath + 'pre_outputs/', non_nan, fpath + 'pre_outputs/SL/')
-
-############################
-
-# Run all analyses in each searchlight
-# This will take ~1000 CPU hours, and so should be run
-# in parallel on a cluster if possible
-
-
-for sl_i in range(nSL):
-
-    # Load data for this searchlight
-    sl_h5 = tables.open_file(fpath + 'pre_outputs/SL/%d.h5' % sl_i, mode='r')
-    data_list_orig = []
-    for subj in subjects:
-        subjname = '/subj_' + subj.split('/')[-1]
-        d = sl_h5.get_node(subjname, 'IN').read()
-        data_list_orig.append(d)
-    sl_h5.close()
-    nSubj = len(data_list_orig)
-
-    sl_K = []
-    sl_seg = []
-    sl_shift_corr = []
-    rng = default_rng(0)
-    # Repeat analyses for each permutation
-    for p in range(nPerm):
-        data_list = []
-        for s in range(nSubj):
-            if p == 0:
-                # This is the real (non-permuted) analysis
-                subj_perm = np.arange(6)
-            else:
-                subj_perm = rng.permutation(6)
-            data_list.append(data_list_orig[s][subj_perm])
-
-        # Run all three analysis types
-        sl_K.append(optimal_events(data_list, subjects))
-        sl_seg.append(fit_HMM(data_list))
-        sl_shift_corr.append(shift_corr(data_list, max_lag))
-
-    # Save results for this searchlight
-    pickle.dump(sl_K,
-                open(fpath + 'out/perm/optimal_events_%d.p' % sl_i, 'wb'))
-    pickle.dump(sl_seg,
-                open(fpath + 'out/perm/fit_HMM_%d.p' % sl_i, 'wb'))
-    pickle.dump(sl_shift_corr,
-                open(fpath + 'out/perm/shift_corr_%d.p' % sl_i, 'wb'))
-
-# Compile results into final maps
-SL_allvox = pickle.load(open(fpath + 'pre_outputs/SL/SL_allvox.p', 'rb'))
-#SL_allvox = list(reversed(SL_allvox[5791:5792]))
-
-compile_optimal_events(fpath + 'out/perm/', non_nan, SL_allvox,
-                        header_fpath, fpath + 'out/')
-
-opt_event = nib.load(fpath + 'out/optimal_events.nii').get_fdata().T
-compile_fit_HMM(fpath + 'out/perm/', non_nan, SL_allvox,
-                header_fpath, fpath + 'out/', opt_event)
-
-compile_shift_corr(fpath + 'out/perm/', non_nan, SL_allvox,
-                header_fpath, fpath + 'out/')
\ No newline at end of file
+# Prepare the clips, valid voxel mask and searchlight store once with
+# python main.py prepare
+# and then either run all searchlights and compile the maps on one node with
+# python main.py
+# or run one shard of the searchlights on each of several nodes with
+# python main.py <shard> <n_shards>
+# and compile the maps with a final run of python main.py once all shards
+# have finished (searchlights that are already done are skipped)
+prepare = sys.argv[1:] == ['prepare']
+if len(sys.argv) > 2:
+    shard, n_shards = int(sys.argv[1]), int(sys.argv[2])
+else:
+    shard, n_shards = 0, 1
+
+
+if __name__ == '__main__':
+
+    import os
+    import nibabel as nib
+
+    store_fpath = fpath + 'pre_outputs/SL/SL.h5'
+
+    ############################
+    #       ONE TIME RUN       #
+    ############################
+
+    # Shard runs never prepare, so that they cannot rewrite the store while
+    # other nodes are reading it
+    if prepare or (n_shards == 1 and not os.path.exists(store_fpath)):
+        # Save clips to save time during the analysis
+        scans_to_clips(fpath, subjects)
+
+        # # Create valid_vox.nii mask
+        find_valid_vox(fpath + 'pre_outputs/', subjects)
+
+        # Create a single data store for all searchlights
+        valid_vox = nib.load(fpath + 'pre_outputs/valid_vox.nii')
+        save_s_lights(fpath + 'pre_outputs/', valid_vox.get_fdata().T > 0,
+                      fpath + 'pre_outputs/SL/', dtype=dtype)
+
+        # Check that float32 gives the same maps on a sample of searchlights
+        if dtype == np.float32:
+            SL_allvox = pickle.load(open(fpath + 'pre_outputs/SL/SL_allvox.p',
+                                         'rb'))
+            validate_float32(store_fpath, subjects, np.random.default_rng(0)
+                             .choice(len(SL_allvox), 10, replace=False),
+                             nPerm, max_lag)
+    elif not os.path.exists(store_fpath):
+        sys.exit('No searchlight store, run python main.py prepare first')
+    if prepare:
+        sys.exit()
+
+    ############################
+
+    # Run all analyses in each searchlight
+    # This will take ~1000 CPU hours, and so is run in a pool of worker
+    # processes, and can be split across nodes with the shard arguments
+
+    non_nan = nib.load(fpath + 'pre_outputs/valid_vox.nii').get_fdata().T > 0
+    SL_allvox = pickle.load(open(fpath + 'pre_outputs/SL/SL_allvox.p', 'rb'))
+    run_s_lights(shard_s_lights(len(SL_allvox), shard, n_shards),
+                 [len(sl) for sl in SL_allvox], store_fpath, subjects, nPerm,
+                 max_lag, fpath + 'out/perm/', n_jobs=n_jobs,
+                 batch_size=batch_size, cache_dir=cache_dir,
+                 cache_size=cache_size, profile_path=profile_path,
+                 shared_dir=shared_dir)
+
+    # Compile results into final maps, once all shards have finished
+    #SL_allvox = list(reversed(SL_allvox[5791:5792]))
+    if n_shards > 1:
+        sys.exit()
+
+    merge_results(fpath + 'out/perm/', len(SL_allvox), nPerm, max_lag)
+
+    compile_optimal_events(fpath + 'out/perm/', non_nan, SL_allvox,
+                            header_fpath, fpath + 'out/')
+
+    opt_event = nib.load(fpath + 'out/optimal_events.nii').get_fdata().T
+    compile_fit_HMM(fpath + 'out/perm/', non_nan, SL_allvox,
+                    header_fpath, fpath + 'out/', opt_event)
+
+    compile_shift_corr(fpath + 'out/perm/', non_nan, SL_allvox,
+                    header_fpath, fpath + 'out/')
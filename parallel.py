@@ -0,0 +1,393 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import profiling
+from data import load_s_light
+from shared import publish_store, open_store, unpublish_store
+from results import PART_SIZE, create_results, open_results, part_path, \
+                    read_ledger
+from s_light import run_searchlight, HMM_stats, shift_corr_stats
+from utils import get_perms, perm_p_interval, ev_annot_freq, hrf_convolution
+
+BLAS_THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                    'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                    'NUMEXPR_NUM_THREADS']
+
+ANALYSES = ['optimal_events', 'fit_HMM', 'shift_corr']
+
+# Searchlight store and result parts opened by each worker process
+_worker_h5 = None
+_worker_results = {}
+
+
+def limit_blas_threads(n_threads=1):
+    """Pin the BLAS and OpenMP thread pools of this process
+
+    Parameters
+    ----------
+    n_threads : int
+        Number of threads each pool may use
+    """
+
+    for var in BLAS_THREAD_VARS:
+        os.environ[var] = str(n_threads)
+
+    # Pools that were already started ignore the environment variables
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(n_threads)
+
+
+def shard_s_lights(nSL, shard=0, n_shards=1):
+    """Contiguous range of searchlights to run on one node
+
+    Shards are made of whole result parts (see results.part_path), so that
+    the shards never write to the same files. There is at most one shard
+    per part; with more shards than parts, the extra shards are empty.
+
+    Parameters
+    ----------
+    nSL : int
+        Total number of searchlights
+    shard : int
+        Index of this shard, from 0 to n_shards - 1
+    n_shards : int
+        Number of nodes the searchlights are split across
+
+    Returns
+    -------
+    range
+        Searchlight indices in this shard
+    """
+
+    assert 0 <= shard < n_shards, "shard must be between 0 and n_shards - 1"
+    n_parts = -(-nSL // PART_SIZE)
+    return range(min(PART_SIZE * (shard * n_parts // n_shards), nSL),
+                 min(PART_SIZE * ((shard + 1) * n_parts // n_shards), nSL))
+
+
+def schedule_s_lights(sl_ids, SL_sizes):
+    """Order searchlights from most to fewest voxels
+
+    Running the most expensive searchlights first keeps workers from idling
+    on a few large searchlights at the end of the run.
+
+    Parameters
+    ----------
+    sl_ids : iterable of ints
+        Searchlight indices to run
+    SL_sizes : sequence of ints
+        Number of voxels in each searchlight
+
+    Returns
+    -------
+    list of ints
+        Searchlight indices, largest first
+    """
+
+    return sorted(sl_ids, key=lambda sl_i: -SL_sizes[sl_i])
+
+
+def _append_ledger(save_path, units):
+    """Record units as done, with a single append that workers can share"""
+
+    # Each line ends with 'done' and each write starts on a new line, so
+    # that a partial line from an interrupted write is never read as a unit
+    lines = ''.join('\n%s %d %d done' % unit for unit in units) + '\n'
+
+    fd = os.open(save_path + 'ledger.txt',
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, lines.encode())
+    finally:
+        os.close(fd)
+
+
+def missing_units(done, sl_i, nPerm):
+    """Permutations that still have to be run for each analysis
+
+    Parameters
+    ----------
+    done : set of tuples
+        Completed units, from read_ledger
+    sl_i : int
+        Index of the searchlight
+    nPerm : int
+        Number of permutations, including the real analysis
+
+    Returns
+    -------
+    dict
+        Maps each analysis name to a list of missing permutation indices
+    """
+
+    return {name: [p for p in range(nPerm) if (name, sl_i, p) not in done]
+            for name in ANALYSES}
+
+
+def run_s_light(sl_h5, results, sl_i, subjects, nPerm, max_lag, save_path,
+                missing=None, batch_size=None, alpha=0.05, conf=0.99,
+                cache_dir=None, cache_size=2**30, first_sl=0):
+    """Run all analyses in one searchlight and save the results
+
+    Only the permutations listed in missing are computed. They are written
+    into the result arrays and flushed to disk before the new units are
+    added to the ledger.
+
+    If batch_size is given, the permutations are run in batches, and the
+    searchlight is stopped after a batch once it is decided: the
+    Clopper-Pearson interval of the permutation p value of every statistic
+    in the final maps lies entirely above or below alpha. The remaining
+    permutations are left as NaN, and the number of permutations run is
+    stored in results['n_perms'].
+
+    Parameters
+    ----------
+    sl_h5 : tables.File
+        Open searchlight store
+    results : dict
+        Result arrays of the part that holds the searchlight, opened for
+        writing with open_results
+    sl_i : int
+        Index of the searchlight
+    subjects : list
+        List of subject directories
+    nPerm : int
+        Number of permutations, including the real analysis
+    max_lag : int
+        Maximum lag for shift_corr
+    save_path : string
+        Directory of the result arrays and ledger of the part
+    missing : dict, optional
+        Permutations to run for each analysis, from missing_units (defaults
+        to all of them)
+    batch_size : int, optional
+        Number of permutations in each batch (defaults to running all of
+        them without stopping early)
+    alpha : float
+        p value threshold that the searchlight must be decided against
+    conf : float
+        Confidence level of the p value intervals
+    cache_dir : string, optional
+        Directory of the result cache (see run_searchlight)
+    cache_size : int
+        Maximum size of the result cache in bytes
+    first_sl : int
+        Index of the searchlight in the first row of the result arrays
+    """
+
+    if missing is None:
+        missing = {name: list(range(nPerm)) for name in ANALYSES}
+    if batch_size is None:
+        batches = [range(nPerm)]
+    else:
+        batches = [range(b, min(b + batch_size, nPerm))
+                   for b in range(0, nPerm, batch_size)]
+
+    row = sl_i - first_sl
+    data_list_orig = None
+    profiling.set_fields(sl=sl_i, n_vox=None)
+    for batch in batches:
+        batch_missing = {name: [p for p in missing[name] if p in batch]
+                         for name in ANALYSES}
+        if any(batch_missing.values()):
+            # Load data for this searchlight
+            if data_list_orig is None:
+                with profiling.stage('load'):
+                    data_list_orig = load_s_light(sl_h5, sl_i, subjects)
+                perms = get_perms(len(data_list_orig), nPerm)
+                profiling.set_fields(n_vox=data_list_orig[0].shape[2])
+
+            # Run all three analysis types for the batch at once
+            sl_results = run_searchlight(data_list_orig, perms, subjects,
+                                         max_lag, batch_missing,
+                                         cache_dir=cache_dir,
+                                         cache_size=cache_size)
+
+            # Save results for this batch, then record them as done
+            with profiling.stage('save', perms=list(batch)):
+                for name in ANALYSES:
+                    if batch_missing[name]:
+                        results[name][row, batch_missing[name]] = \
+                            sl_results[name]
+                units = []
+                for name in ANALYSES:
+                    results[name].flush()
+                    units.extend((name, sl_i, p) for p in batch_missing[name])
+                _append_ledger(save_path, units)
+
+        n_run = batch.stop
+        if batch_size is not None:
+            with profiling.stage('decide', perms=list(batch)):
+                decided = s_light_decided(results, row, n_run, max_lag,
+                                          alpha, conf)
+            if decided:
+                break
+
+    results['n_perms'][row] = n_run
+    results['n_perms'].flush()
+    profiling.set_fields(sl=None, n_vox=None)
+
+
+def s_light_decided(results, row, nPerm, max_lag, alpha=0.05, conf=0.99):
+    """Whether the permutation test of a searchlight has been decided
+
+    The statistics are those of the final maps: anticipation in each
+    repetition and on average, the shift in peak lag of correlation with
+    annotations, and the peak of shift_corr.
+
+    Parameters
+    ----------
+    results : dict
+        Result arrays, from open_results
+    row : int
+        Row of the searchlight in the result arrays
+    nPerm : int
+        Number of permutations that have been run
+    max_lag : int
+        Maximum lag for shift_corr
+    alpha : float
+        p value threshold
+    conf : float
+        Confidence level of the p value intervals
+
+    Returns
+    -------
+    bool
+        True if all p value intervals are entirely above or below alpha
+    """
+
+    ev_conv = hrf_convolution(ev_annot_freq())
+    AUCdiffs, peak_shift = HMM_stats(
+        np.array(results['fit_HMM'][row, :nPerm]), ev_conv, max_lag)
+    corrshift = shift_corr_stats(
+        np.array(results['shift_corr'][row, :nPerm]), max_lag)
+    stats = np.column_stack([AUCdiffs.T, AUCdiffs.mean(0), peak_shift,
+                             corrshift])
+
+    lower, upper = perm_p_interval(stats, conf)
+    return bool(np.all((upper < alpha) | (lower > alpha)))
+
+
+def _init_worker(store_fpath, n_threads, profile_path=None, shared_dir=None):
+    """Pin BLAS threads and open the searchlight store"""
+
+    global _worker_h5
+    import tables
+
+    limit_blas_threads(n_threads)
+    if profile_path is not None:
+        profiling.enable(profile_path)
+    if shared_dir is not None:
+        _worker_h5 = open_store(shared_dir)
+    else:
+        _worker_h5 = tables.open_file(store_fpath, mode='r')
+
+
+def _run_worker(sl_i, subjects, nPerm, max_lag, save_path, *args, **kwargs):
+    # Open the result part of this searchlight the first time it is needed
+    part, first_sl = part_path(save_path, sl_i)
+    if part not in _worker_results:
+        _worker_results[part] = open_results(part, mode='r+')
+    run_s_light(_worker_h5, _worker_results[part], sl_i, subjects, nPerm,
+                max_lag, part, *args, first_sl=first_sl, **kwargs)
+    return sl_i
+
+
+def run_s_lights(sl_ids, SL_sizes, store_fpath, subjects, nPerm, max_lag,
+                 save_path, n_jobs=None, n_threads=1, batch_size=None,
+                 alpha=0.05, conf=0.99, cache_dir=None, cache_size=2**30,
+                 profile_path=None, shared_dir=None):
+    """Run all analyses for many searchlights in a pool of processes
+
+    Results and ledgers are written into the part directories of save_path
+    that hold the searchlights (see results.part_path), which are merged
+    with results.merge_results before compiling the maps. Runs on several
+    nodes must not share parts, as with the shards of shard_s_lights. Units
+    already recorded in the ledgers are skipped, so an interrupted run can
+    be resumed, with the same or different shards, and nPerm can be
+    increased without recomputing the existing permutations. Searchlights
+    are submitted largest first, and each idle worker takes the next one
+    from the queue, so long and short searchlights are balanced across
+    workers. Each worker opens its own handle to the searchlight store
+    and runs BLAS with n_threads threads, so that n_jobs * n_threads should
+    not exceed the number of cores.
+
+    If shared_dir is given, the searchlight data and voxel table are instead
+    published once per node into memory-mapped arrays in shared_dir (see
+    shared.publish_store), which all workers map without copying, and
+    removed again at the end if this call published them.
+
+    Parameters
+    ----------
+    sl_ids : iterable of ints
+        Searchlight indices to run, e.g. a range from shard_s_lights
+    SL_sizes : sequence of ints
+        Number of voxels in each searchlight
+    store_fpath : string
+        Searchlight store written by save_s_lights
+    subjects : list
+        List of subject directories
+    nPerm : int
+        Number of permutations, including the real analysis
+    max_lag : int
+        Maximum lag for shift_corr
+    save_path : string
+        Directory for the result parts
+    n_jobs : int, optional
+        Number of worker processes (defaults to the number of CPUs)
+    n_threads : int, optional
+        Number of BLAS threads per worker
+    batch_size : int, optional
+        Run permutations in batches of this size and stop each searchlight
+        once it is decided (see run_s_light)
+    alpha : float
+        p value threshold for stopping early
+    conf : float
+        Confidence level of the p value intervals for stopping early
+    cache_dir : string, optional
+        Directory of a result cache shared by all workers, so that results
+        whose inputs have not changed are not recomputed
+    cache_size : int
+        Maximum size of the result cache in bytes
+    profile_path : string, optional
+        File to log the wall time, CPU time and peak memory of each stage of
+        each searchlight to (see profiling.py for a summary tool)
+    shared_dir : string, optional
+        Directory in shared memory (e.g. under /dev/shm) to publish the
+        searchlight data in for all workers of the node
+    """
+
+    parts = sorted(set(part_path(save_path, sl_i) for sl_i in sl_ids))
+    done = set()
+    for part, _ in parts:
+        done.update(read_ledger(part))
+    missing = {sl_i: missing_units(done, sl_i, nPerm) for sl_i in sl_ids}
+    order = schedule_s_lights([sl_i for sl_i in missing
+                               if any(missing[sl_i].values())], SL_sizes)
+    print('%d of %d searchlights already done' %
+          (len(missing) - len(order), len(missing)))
+
+    for part, _ in parts:
+        os.makedirs(part, exist_ok=True)
+        create_results(part, PART_SIZE, nPerm, max_lag)
+    published = shared_dir is not None and \
+                publish_store(store_fpath, shared_dir)
+    args = (subjects, nPerm, max_lag, save_path)
+    try:
+        with ProcessPoolExecutor(n_jobs, initializer=_init_worker,
+                                 initargs=(store_fpath, n_threads,
+                                           profile_path, shared_dir)) as pool:
+            futures = [pool.submit(_run_worker, sl_i, *args, missing[sl_i],
+                                   batch_size=batch_size, alpha=alpha,
+                                   conf=conf, cache_dir=cache_dir,
+                                   cache_size=cache_size)
+                       for sl_i in order]
+            for n_done, future in enumerate(as_completed(futures)):
+                print('Searchlight %d done (%d/%d)' %
+                      (future.result(), n_done + 1, len(order)))
+    finally:
+        if published:
+            unpublish_store(shared_dir)
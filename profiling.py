@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+import numpy as np
+
+# Log file of this process (profiling is off while it is None), fields
+# added to every record, and peak memory of the stages being timed
+_log_fpath = None
+_fields = {}
+_stack = []
+
+
+def enable(log_fpath):
+    """Start logging the cost of each stage of this process to log_fpath
+
+    Parameters
+    ----------
+    log_fpath : string
+        File to append JSON records to, one line per stage (can be shared by
+        several processes)
+    """
+
+    global _log_fpath
+    _log_fpath = log_fpath
+
+
+def disable():
+    """Stop logging stages"""
+
+    global _log_fpath
+    _log_fpath = None
+
+
+def set_fields(**fields):
+    """Add fields (e.g. the searchlight) to all following records
+
+    Fields set to None are removed.
+    """
+
+    _fields.update(fields)
+    for k in [k for k, v in _fields.items() if v is None]:
+        del _fields[k]
+
+
+def reset_peak():
+    """Reset the peak RSS of this process, if the OS allows it"""
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_mb():
+    """Peak RSS of this process in MB, since the last reset_peak on Linux"""
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    # Elsewhere, the peak of the whole process (ru_maxrss is in bytes on
+    # macOS, and in kB elsewhere)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+@contextmanager
+def stage(name, **fields):
+    """Time a stage and log its wall time, CPU time and peak memory
+
+    Does nothing unless profiling has been enabled. Stages can be nested;
+    the peak memory of a stage includes that of the stages inside it.
+
+    Parameters
+    ----------
+    name : string
+        Stage name, e.g. 'load' or 'fit_HMM'
+    fields : dict
+        Fields added to this record, e.g. the permutations of the stage
+    """
+
+    if _log_fpath is None:
+        yield
+        return
+
+    # The peak so far belongs to the enclosing stage, before it is reset
+    if _stack:
+        _stack[-1] = max(_stack[-1], peak_mb())
+    _stack.append(0.0)
+    reset_peak()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+        peak = max(_stack.pop(), peak_mb())
+        if _stack:
+            _stack[-1] = max(_stack[-1], peak)
+
+        record = dict(_fields, stage=name, pid=os.getpid(),
+                      t=round(time.time(), 3), wall=round(wall, 4),
+                      cpu=round(cpu, 4), peak_mb=round(peak, 1))
+        record.update(fields)
+        line = json.dumps(record, separators=(',', ':'),
+                          default=lambda x: np.asarray(x).tolist()) + '\n'
+
+        # One append per record, so that processes can share the log
+        fd = os.open(_log_fpath, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+
+def load_profile(log_fpath):
+    """Read the records of a profile log
+
+    Parameters
+    ----------
+    log_fpath : string
+        Log written by stage
+
+    Returns
+    -------
+    list of dicts
+        Records of all stages, skipping partial lines
+    """
+
+    records = []
+    with open(log_fpath) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def summarize(records, nSL=None, top=10):
+    """Hotspots, progress and cost per voxel of a profiled run
+
+    Parameters
+    ----------
+    records : list of dicts
+        Records from load_profile
+    nSL : int, optional
+        Total number of searchlights of the run, to estimate the time left
+    top : int
+        Number of most expensive searchlights to list
+
+    Returns
+    -------
+    dict
+        'stages': calls, total and mean wall time, CPU time, share of the
+        total wall time and peak memory of each stage, most expensive first
+        'searchlights': total wall time, voxels and permutations of the
+        most expensive searchlights
+        'progress': searchlights profiled, elapsed time, throughput and
+        (if nSL is given) estimated time left
+        'voxels': exponent and coefficient of a power law fit of the wall
+        time per permutation to the searchlight size, and mean cost in
+        quartiles of searchlight size
+    """
+
+    # Total cost of each stage (the pipeline does not nest stages, so the
+    # shares add up to the total)
+    stages = {}
+    for r in records:
+        s = stages.setdefault(r['stage'], {'calls': 0, 'wall': 0.0,
+                                           'cpu': 0.0, 'peak_mb': 0.0})
+        s['calls'] += 1
+        s['wall'] += r['wall']
+        s['cpu'] += r['cpu']
+        s['peak_mb'] = max(s['peak_mb'], r['peak_mb'])
+    total_wall = sum(s['wall'] for s in stages.values())
+    for s in stages.values():
+        s['mean_wall'] = s['wall'] / s['calls']
+        s['share'] = s['wall'] / total_wall if total_wall > 0 else 0.0
+    stages = dict(sorted(stages.items(), key=lambda s: -s[1]['wall']))
+
+    # Cost of each searchlight, and permutations computed in it
+    sls = {}
+    for r in records:
+        if 'sl' not in r:
+            continue
+        sl = sls.setdefault(r['sl'], {'wall': 0.0, 'n_vox': 0, 'perms': 0})
+        sl['wall'] += r['wall']
+        sl['n_vox'] = r.get('n_vox', sl['n_vox'])
+        if r['stage'] == 'fit_HMM':
+            sl['perms'] += len(r.get('perms', []))
+    expensive = dict(sorted(sls.items(), key=lambda s: -s[1]['wall'])[:top])
+
+    start = min((r['t'] - r['wall'] for r in records), default=0.0)
+    elapsed = max((r['t'] for r in records), default=0.0) - start
+    progress = {'n_s_lights': len(sls), 'elapsed': elapsed,
+                's_lights_per_hour': 3600 * len(sls) / elapsed
+                                     if elapsed > 0 else np.nan}
+    if nSL is not None:
+        progress['eta_hours'] = (nSL - len(sls)) / \
+                                progress['s_lights_per_hour']
+
+    # Wall time per permutation as a function of searchlight size
+    sized = [sl for sl in sls.values() if sl['n_vox'] > 0 and sl['perms'] > 0]
+    voxels = {'exponent': np.nan, 'coefficient': np.nan, 'quartiles': []}
+    if len(sized) > 1:
+        n_vox = np.array([sl['n_vox'] for sl in sized])
+        cost = np.array([sl['wall'] / sl['perms'] for sl in sized])
+        if len(np.unique(n_vox)) > 1:
+            b, log_a = np.polyfit(np.log(n_vox), np.log(cost), 1)
+            voxels['exponent'], voxels['coefficient'] = b, np.exp(log_a)
+        edges = np.quantile(n_vox, [0, 0.25, 0.5, 0.75, 1])
+        bins = np.clip(np.searchsorted(edges, n_vox, side='right') - 1, 0, 3)
+        for q in range(4):
+            if np.any(bins == q):
+                voxels['quartiles'].append(
+                    {'min_vox': int(n_vox[bins == q].min()),
+                     'max_vox': int(n_vox[bins == q].max()),
+                     'n_s_lights': int(np.sum(bins == q)),
+                     'wall_per_perm': float(cost[bins == q].mean())})
+
+    return {'stages': stages, 'searchlights': expensive,
+            'progress': progress, 'voxels': voxels}
+
+
+def print_summary(summary):
+    """Print the output of summarize as tables"""
+
+    print('%-16s %7s %10s %10s %10s %6s %9s' %
+          ('stage', 'calls', 'wall (s)', 'mean (s)', 'cpu (s)', 'share',
+           'peak (MB)'))
+    for name, s in summary['stages'].items():
+        print('%-16s %7d %10.1f %10.3f %10.1f %5.1f%% %9.0f' %
+              (name, s['calls'], s['wall'], s['mean_wall'], s['cpu'],
+               100 * s['share'], s['peak_mb']))
+
+    print('\nMost expensive searchlights:')
+    for sl_i, sl in summary['searchlights'].items():
+        print('   %6s: %8.1f s, %5d voxels, %4d permutations' %
+              (sl_i, sl['wall'], sl['n_vox'], sl['perms']))
+
+    progress = summary['progress']
+    print('\n%d searchlights in %.2f hours (%.1f per hour)' %
+          (progress['n_s_lights'], progress['elapsed'] / 3600,
+           progress['s_lights_per_hour']))
+    if 'eta_hours' in progress:
+        print('Estimated time left: %.1f hours' % progress['eta_hours'])
+
+    voxels = summary['voxels']
+    print('\nWall time per permutation ~ %.3g * voxels^%.2f' %
+          (voxels['coefficient'], voxels['exponent']))
+    for q in voxels['quartiles']:
+        print('   %5d-%5d voxels: %8.3f s per permutation (%d searchlights)'
+              % (q['min_vox'], q['max_vox'], q['wall_per_perm'],
+                 q['n_s_lights']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Summarize a profile log written with profile_path')
+    parser.add_argument('log', help='profile log')
+    parser.add_argument('--n-s-lights', type=int,
+                        help='total number of searchlights, for the ETA')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    print_summary(summarize(load_profile(args.log), args.n_s_lights,
+                            args.top))
@@ -0,0 +1,307 @@
+import glob
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# Number of consecutive searchlights whose results are stored together
+PART_SIZE = 64
+
+
+def result_specs(max_lag, nReps=6, nTR=60, n_events=7):
+    """Storage format of the result of each analysis
+
+    Parameters
+    ----------
+    max_lag : int
+        Maximum lag for shift_corr
+    nReps : int
+        Number of repetitions
+    nTR : int
+        Number of TRs in each repetition
+    n_events : int
+        Number of events in the fit_HMM segmentations
+
+    Returns
+    -------
+    dict
+        Maps each analysis name to (dtype, shape of one result, fill value
+        for results that have not been computed)
+    """
+
+    return {'optimal_events': (np.int16, (), -1),
+            'fit_HMM': (np.float64, (nReps, nTR, n_events), np.nan),
+            'shift_corr': (np.float64, (1 + 2*max_lag,), np.nan)}
+
+
+def part_path(save_path, sl_i):
+    """Directory of the result part that holds a searchlight
+
+    Results are stored in parts of PART_SIZE consecutive searchlights, each
+    with its own result arrays and ledger. Shards of a run are made of whole
+    parts (see parallel.shard_s_lights), so that no two nodes ever write to
+    the same file.
+
+    Parameters
+    ----------
+    save_path : string
+        Directory of all result parts
+    sl_i : int
+        Index of the searchlight
+
+    Returns
+    -------
+    string
+        Part directory, inside save_path
+
+    int
+        Index of the searchlight in the first row of the part
+    """
+
+    first_sl = sl_i - sl_i % PART_SIZE
+    return save_path + 'sl_%d-%d/' % (first_sl, first_sl + PART_SIZE), \
+           first_sl
+
+
+def list_parts(save_path):
+    """Find all result parts in save_path
+
+    Parameters
+    ----------
+    save_path : string
+        Directory of all result parts
+
+    Returns
+    -------
+    list of tuples
+        (first_sl, stop_sl, part directory) of each part
+    """
+
+    parts = []
+    for part in glob.glob(save_path + 'sl_*-*/'):
+        first_sl, stop_sl = os.path.basename(part[:-1])[3:].split('-')
+        parts.append((int(first_sl), int(stop_sl), part))
+    return sorted(parts)
+
+
+def create_results(save_path, nSL, nPerm, max_lag, block=256):
+    """Create or grow the result arrays for all analyses
+
+    Each analysis is stored as one .npy file of shape nSL x nPerm x result,
+    which workers open as memory maps and fill in place. Existing arrays
+    with fewer searchlights or permutations are copied into a larger array,
+    so that nPerm can be increased without losing computed results. The
+    number of permutations run in each searchlight is stored in n_perms.npy.
+
+    Growing an array replaces its file, so this must not be called while
+    other processes have the arrays open.
+
+    Parameters
+    ----------
+    save_path : string
+        Directory for the result arrays, e.g. from part_path
+    nSL : int
+        Number of searchlights
+    nPerm : int
+        Number of permutations, including the real analysis
+    max_lag : int
+        Maximum lag for shift_corr
+    block : int
+        Number of searchlights to fill or copy at a time
+    """
+
+    for name, (dtype, shape, fill) in result_specs(max_lag).items():
+        _grow_array(save_path + name + '.npy', (nSL, nPerm), dtype, shape,
+                    fill, block)
+    _grow_array(save_path + 'n_perms.npy', (nSL,), np.int32, (), 0, block)
+
+
+def _grow_array(fname, size, dtype, shape, fill, block):
+    """Create an array of at least size x shape, keeping existing values"""
+
+    old = np.load(fname, mmap_mode='r') if os.path.exists(fname) else None
+    if old is not None and all(o >= n for o, n in zip(old.shape, size)):
+        return
+
+    new_size = size
+    if old is not None:
+        new_size = tuple(max(o, n) for o, n in zip(old.shape, size))
+    tmp_fname = fname + '.%d.tmp' % os.getpid()
+    new = open_memmap(tmp_fname, mode='w+', dtype=dtype,
+                      shape=new_size + shape)
+    old_cols = tuple(slice(0, o) for o in old.shape[1:len(size)]) \
+               if old is not None else ()
+    for sl_start in range(0, new_size[0], block):
+        sl_block = slice(sl_start, sl_start + block)
+        new[sl_block] = fill
+        if old is not None:
+            new[(sl_block,) + old_cols] = old[sl_block]
+    new.flush()
+    del new, old
+    os.replace(tmp_fname, fname)
+
+
+def read_ledger(save_path):
+    """Read the units recorded as done in the results ledger
+
+    The ledger (save_path/ledger.txt) has one line per completed
+    (analysis, searchlight, permutation) unit. Lines are only appended after
+    the results they describe have been saved, so a unit in the ledger never
+    has to be recomputed, and a crash can at most lose the record of units
+    that are then computed again.
+
+    Parameters
+    ----------
+    save_path : string
+        Directory for the result arrays and ledger
+
+    Returns
+    -------
+    set of tuples
+        (analysis, sl_i, p) for each completed unit
+    """
+
+    done = set()
+    if os.path.exists(save_path + 'ledger.txt'):
+        with open(save_path + 'ledger.txt') as f:
+            for line in f:
+                unit = line.split()
+                # Skip partial lines left by an interrupted write
+                if len(unit) == 4 and unit[3] == 'done':
+                    done.add((unit[0], int(unit[1]), int(unit[2])))
+    return done
+
+
+def merge_results(save_path, nSL, nPerm, max_lag, block=256):
+    """Merge the result parts of all shards into one array per analysis
+
+    The units recorded in the ledger of each part (see list_parts) are
+    copied into save_path/<analysis>.npy, of shape nSL x nPerm x result, and
+    the number of permutations run in each searchlight into
+    save_path/n_perms.npy. Units that are not in any ledger keep the fill
+    value of result_specs. This is run once all shards have finished.
+
+    Parameters
+    ----------
+    save_path : string
+        Directory of all result parts, to save the merged arrays in
+    nSL : int
+        Number of searchlights
+    nPerm : int
+        Number of permutations, including the real analysis
+    max_lag : int
+        Maximum lag for shift_corr
+    block : int
+        Number of searchlights to copy at a time
+    """
+
+    parts = [(first_sl, min(stop_sl, nSL), part, read_ledger(part))
+             for first_sl, stop_sl, part in list_parts(save_path)
+             if first_sl < nSL]
+    tmp = '.%d.tmp' % os.getpid()
+
+    for name, (dtype, shape, fill) in result_specs(max_lag).items():
+        merged = open_memmap(save_path + name + '.npy' + tmp, mode='w+',
+                             dtype=dtype, shape=(nSL, nPerm) + shape)
+        for sl_start in range(0, nSL, block):
+            merged[sl_start:(sl_start + block)] = fill
+        for first_sl, stop_sl, part, done in parts:
+            # Units of this part that are recorded as done
+            is_done = np.zeros((stop_sl - first_sl, nPerm), bool)
+            for unit_name, sl_i, p in done:
+                if unit_name == name and first_sl <= sl_i < stop_sl \
+                        and p < nPerm:
+                    is_done[sl_i - first_sl, p] = True
+
+            arr = np.load(part + name + '.npy', mmap_mode='r')
+            n_cols = min(nPerm, arr.shape[1])
+            is_done = is_done[:, :n_cols]
+            for row in range(0, stop_sl - first_sl, block):
+                rows = slice(row, min(row + block, stop_sl - first_sl))
+                if np.any(is_done[rows]):
+                    sl_block = merged[first_sl + rows.start:
+                                      first_sl + rows.stop, :n_cols]
+                    sl_block[is_done[rows]] = arr[rows, :n_cols][is_done[rows]]
+        merged.flush()
+        del merged
+        os.replace(save_path + name + '.npy' + tmp, save_path + name + '.npy')
+
+    n_perms = np.zeros(nSL, np.int32)
+    for first_sl, stop_sl, part, _ in parts:
+        part_n_perms = np.load(part + 'n_perms.npy')[:stop_sl - first_sl]
+        np.maximum(n_perms[first_sl:stop_sl], part_n_perms,
+                   out=n_perms[first_sl:stop_sl])
+    with open(save_path + 'n_perms.npy' + tmp, 'wb') as f:
+        np.save(f, np.minimum(n_perms, nPerm))
+    os.replace(save_path + 'n_perms.npy' + tmp, save_path + 'n_perms.npy')
+
+
+def open_results(save_path, mode='r'):
+    """Open the result arrays as memory maps
+
+    Workers open the arrays of their part with mode='r+' and write their
+    own (searchlight, permutation) entries, which never overlap, so any
+    number of processes of a node can append results at the same time.
+
+    Parameters
+    ----------
+    save_path : string
+        Directory of the result arrays (a part, or merged by merge_results)
+    mode : string
+        'r' to read or 'r+' to write results
+
+    Returns
+    -------
+    dict
+        Maps each analysis name to a nSL x nPerm x result memory map, and
+        'n_perms' to the number of permutations run in each searchlight
+    """
+
+    return {name: np.load(save_path + name + '.npy', mmap_mode=mode)
+            for name in ['optimal_events', 'fit_HMM', 'shift_corr',
+                         'n_perms']}
+
+
+def results_size(save_path):
+    """Number of searchlights and permutations of the result arrays
+
+    Parameters
+    ----------
+    save_path : string
+        Directory of the result arrays, merged by merge_results
+
+    Returns
+    -------
+    int
+        Number of searchlights
+
+    int
+        Number of permutations, including the real analysis
+    """
+
+    nSL, nPerm = np.load(save_path + 'optimal_events.npy',
+                         mmap_mode='r').shape
+    return nSL, nPerm
+
+
+def load_results(save_path, name, nSL, nPerm):
+    """Load the results of one analysis for all searchlights
+
+    Parameters
+    ----------
+    save_path : string
+        Directory of the result arrays, merged by merge_results
+    name : string
+        Analysis name ('optimal_events', 'fit_HMM' or 'shift_corr')
+    nSL : int
+        Number of searchlights
+    nPerm : int
+        Number of permutations, including the real analysis
+
+    Returns
+    -------
+    ndarray
+        nSL x nPerm x result array
+    """
+
+    return np.array(np.load(save_path + name + '.npy',
+                            mmap_mode='r')[:nSL, :nPerm])
@@ -1,11 +1,11 @@
-import pickle
 import numpy as np
 from numpy.random import default_rng
-from scipy.spatial.distance import cdist
-from scipy.stats import norm, spearmanr
-from utils import get_AUCs, tj_fit, save_nii, hyperalign, heldout_ll, FDR_p, \
-                    get_DTs, ev_annot_freq, hrf_convolution, lag_pearsonr, \
-                    nearest_peak
+import profiling
+from cache import data_digest, cache_key, cache_load, cache_store
+from results import load_results, open_results, results_size
+from utils import get_AUCs, tj_fit, save_niis, hyperalign, heldout_ll_sweep, \
+                    FDR_p, get_DTs, ev_annot_freq, hrf_convolution, \
+                    lag_pearsonr, nearest_peak, shared_reorderings
 
 
 def get_s_lights(coords, stride=5, radius=5, min_vox=20):
@@ -33,18 +33,51 @@ def get_s_lights(coords, stride=5, radius=5, min_vox=20):
         Each list element is the indices of coordinates in a searchlight
     """
 
-    SL_allvox = []
+    geometry = (stride, radius)
+    return sweep_s_lights(coords, [geometry], min_vox)[geometry]
 
-    for x in range(0, np.max(coords, axis=0)[0] + stride, stride):
-        for y in range(0, np.max(coords, axis=0)[1] + stride, stride):
-            for z in range(0, np.max(coords, axis=0)[2] + stride, stride):
-                dists = cdist(coords, np.array([[x, y, z]]))[:, 0]
-                SL_vox = np.where(dists <= radius)[0]
-                if len(SL_vox) >= min_vox:
-                    SL_allvox.append(SL_vox)
-    return SL_allvox
+def sweep_s_lights(coords, geometries, min_vox=20):
+    """Defines searchlight grids for several strides and radii at once
 
-def optimal_events(data_list, subjects):
+    A KD-tree is built over coords once and queried for every grid point of
+    every (stride, radius) combination, instead of computing the distance from
+    every voxel to every grid point. Grid points are visited in the same
+    x/y/z order as a nested loop and voxel indices are sorted, so each result
+    is identical to the brute-force grid search.
+
+    Parameters
+    ----------
+    coords : ndarray
+        V x 3 array, listing XYZ coordinates of all valid voxels
+    geometries : list of tuples
+        (stride, radius) pairs defining each searchlight grid
+    min_vox : int
+        Minimum number of voxels for a valid searchlight
+
+    Returns
+    -------
+    dict
+        Maps each (stride, radius) pair to a list of ndarrays, each the
+        indices of coordinates in a searchlight
+    """
+
+    from scipy.spatial import cKDTree
+
+    tree = cKDTree(coords)
+    max_coords = np.max(coords, axis=0)
+
+    SL_grids = {}
+    for stride, radius in geometries:
+        grid = np.stack(np.meshgrid(
+            *[np.arange(0, m + stride, stride) for m in max_coords],
+            indexing='ij'), axis=-1).reshape(-1, 3)
+        SL_vox = tree.query_ball_point(grid, radius, return_sorted=True)
+        SL_grids[(stride, radius)] = [np.array(sl, dtype=np.intp)
+                                      for sl in SL_vox if len(sl) >= min_vox]
+    return SL_grids
+
+def optimal_events(data_list, subjects, n_jobs=None, warm_start=False,
+                   K_range=np.arange(2, 10)):
     """Find optimal number of events according to log-likelihood on first rep
 
     The event segmentation model is fit with varying number of events, and
@@ -58,6 +91,14 @@ def optimal_events(data_list, subjects):
         List of Reps x TRs x Vox arrays for each subject
     subjects : list of strings
         Names of all subjects
+    n_jobs : int, optional
+        Number of threads to fit the models for different numbers of events
+        in (defaults to fitting serially)
+    warm_start : boolean
+        Whether to initialize each model from the previous number of events
+        (see heldout_ll_sweep)
+    K_range : ndarray
+        Numbers of events to test
 
     Returns
     -------
@@ -65,23 +106,21 @@ def optimal_events(data_list, subjects):
         Number of events with highest log-likelihood
     """
 
-    K_range = np.arange(2, 10) # number of events to test # number of events to test
-    ll = np.zeros(len(K_range))
     split = np.concatenate((np.full(int(len(subjects)/2), True), np.full(int(len(subjects)/2), False))) # creates array of half true half false, assumes even number of subjects
     #split = np.array([('04' in s) for s in subjects]) # hard coded 04, would normally have conditional btwn first and second half of data
     rep1 = np.array([d[0] for d in data_list])
-    for i, K in enumerate(K_range):
-        ll[i] = heldout_ll(rep1, K, split) # calculating the likelihood of each # of events being correct # calculating the likelihood of each # of events being correct
+    ll = heldout_ll_sweep(rep1, K_range, split, n_jobs, warm_start) # calculating the likelihood of each # of events being correct
     return K_range[np.argmax(ll)] # for some reason, on the data I chose (last 5 searchlights) the event seg always returned 2 # for some reason, on the data I chose (last 5 searchlights) the event seg always returned 2
 
-def compile_optimal_events(pickle_path, non_nan_mask, SL_allvox,
+def compile_optimal_events(results_path, non_nan_mask, SL_allvox,
                             header_fpath, save_path):
     """Create MNI map of optimal event numbers
 
     Parameters
     ----------
-    pickle_path : string
-        Filepath to where pickles were saved for each searchlight
+    results_path : string
+        Filepath to where result arrays were merged for all searchlights
+        (see results.merge_results)
     non_nan_mask : ndarray
         3d boolean mask of valid voxels
     SL_allvox : list of ndarrays
@@ -92,43 +131,101 @@ def compile_optimal_events(pickle_path, non_nan_mask, SL_allvox,
         Location of output directory
     """
 
-    nSL = 5247 # 5354
+    nSL, nPerm = results_size(results_path)
+    assert nSL == len(SL_allvox), \
+        "result arrays do not match the number of searchlights"
 
-    sl_K = nSL*[None]
-    for sl_i in range(nSL):
-        pickle_fname = '%soptimal_events_%d.p' % (pickle_path, sl_i)
-        sl_K[sl_i] = pickle.load(open(pickle_fname, 'rb'))
+    sl_K = load_results(results_path, 'optimal_events', nSL, nPerm)
 
     K_vox3d = get_vox_map(sl_K, SL_allvox, non_nan_mask, return_q=False) # putting optimal event data together with valid voxels # putting optimal event data together with valid voxels
-    save_nii(save_path + 'optimal_events.nii', header_fpath, K_vox3d)
+    save_niis(save_path, {'optimal_events': K_vox3d}, header_fpath)
 
 
-def fit_HMM(data_list):
+def fit_HMM(data_list, perms=None, nFeatures=10, n_events=7):
     """Hyperalign and fit HMM to data in one searchlight
 
+    If perms is given, the HMM is fit to each permutation of the reps. The
+    hyperalignment and HMM fits are shared between permutations that
+    reorder the reps of all subjects in the same way, whose segmentations
+    only differ in the order of the reps.
+
     Parameters
     ----------
     data_list : list of ndarrays
         List of Reps x TRs x Vox arrays for each subject
+    perms : ndarray, optional
+        nPerm x nSubj x nReps array of rep orders for each subject
+    nFeatures : int
+        Dimensionality of the hyperaligned shared space
+    n_events : int
+        Number of events to fit
 
     Returns
     -------
     list of ndarrays
-        List of segmentations for each repetition
+        List of segmentations for each repetition, or a nPerm x Reps x TRs x
+        Events array of segmentations if perms is given
+    """
+    if perms is None:
+        hyp_data = hyperalign(data_list, nFeatures)
+        group_data = np.mean(hyp_data, axis=0)
+
+        return tj_fit(group_data, n_events)
+
+    base, orders = shared_reorderings(perms)
+    hyp_data = hyperalign(data_list, nFeatures, perms=perms)
+
+    # Fit HMMs to all permutations that are not reorderings at once
+    fitted = np.flatnonzero(base == np.arange(len(perms)))
+    group_data = np.array([np.mean(hyp_data[p], axis=0) for p in fitted])
+    segs = dict(zip(fitted, tj_fit(group_data, n_events)))
+    return np.array([segs[base[p]][orders[p]] for p in range(len(perms))])
+
+def HMM_stats(segs, ev_conv, max_lag=10, TR=1.5):
+    """Anticipation and lag of annotation correlation for HMM fits
+
+    Parameters
+    ----------
+    segs : ndarray
+        ... x nPerm x Reps x TRs x Events segmentations from fit_HMM, for one
+        searchlight or stacked for several (permutations that have not been
+        run are NaN)
+    ev_conv : ndarray
+        Boundary annotations convolved with an HRF, from hrf_convolution
+    max_lag : int
+        Maximum lag for correlation with annotations
+    TR : float
+        Repetition time in seconds
+
+    Returns
+    -------
+    ndarray
+        ... x Reps-1 x nPerm array of anticipation (shift in AUC relative to
+        the first viewing) in seconds
+
+    ndarray
+        ... x nPerm shift in the peak lag of correlation with annotations, in
+        seconds, for each permutation
     """
-    hyp_data = hyperalign(data_list)
-    group_data = np.mean(hyp_data, axis=0)
 
-    return tj_fit(group_data)
+    nEvents = segs.shape[-1]
+    AUC = get_AUCs(segs)
+    AUCdiffs = np.swapaxes(TR/(nEvents-1) * (AUC[..., 1:] - AUC[..., :1]),
+                           -1, -2)
+
+    peaks = nearest_peak(lag_pearsonr(get_DTs(segs), ev_conv[1:], max_lag))
+    peak_shift = TR*(peaks[..., 1:].mean(-1)-peaks[..., 0])
+    return AUCdiffs, peak_shift
 
-def compile_fit_HMM(pickle_path, non_nan_mask, SL_allvox,
+def compile_fit_HMM(results_path, non_nan_mask, SL_allvox,
                     header_fpath, save_path, opt_event):
     """Create MNI map of HMM fits and compute statistics
 
     Parameters
     ----------
-    pickle_path : string
-        Filepath to where pickles were saved for each searchlight
+    results_path : string
+        Filepath to where result arrays were merged for all searchlights
+        (see results.merge_results)
     non_nan_mask : ndarray
         3d boolean mask of valid voxels
     SL_allvox : list of ndarrays
@@ -141,88 +238,87 @@ def compile_fit_HMM(pickle_path, non_nan_mask, SL_allvox,
         3d volume, result of optimal_event analysis
     """
 
-    nSL = 5247 # 5354
-    nPerm = 3 #100
+    from scipy.stats import norm, spearmanr
+
+    nSL, nPerm = results_size(results_path)
+    assert nSL == len(SL_allvox), \
+        "result arrays do not match the number of searchlights"
     TR = 1.5
-    nEvents = 7
     max_lag = 10
+    block = 64 # searchlights of segmentations loaded at a time
 
     ev_conv = hrf_convolution(ev_annot_freq())
-    lag_corr = nSL*[None]
-    sl_AUCdiffs = nSL*[None]
-    peak_shift = nSL*[None]
-
-    # Load data from all searchlights
-    for sl_i in range(nSL):
-        sl_i = 826
-        sl_AUCdiffs[sl_i] = np.zeros((6-1, nPerm))
-        lag_corr[sl_i] = np.zeros((6, 1 + 2*max_lag, nPerm))
-        peak_shift[sl_i] = np.zeros(nPerm)
-
-        pickle_fname = '%sfit_HMM_%d.p' % (pickle_path, sl_i)
-        pick_data = pickle.load(open(pickle_fname, 'rb'))
-
-        # Compute anticipation and shift in correlation with annotations
-        for p in range(nPerm):
-            p = 1
-            seg = pick_data[p]
-            AUC = get_AUCs(seg)
-            sl_AUCdiffs[sl_i][:,p] = TR/(nEvents-1) * (AUC[1:]-AUC[0])
-            peaks = np.zeros(6)
-            for rep in range(6):
-                sl_DT = get_DTs(seg[rep])
-                lag_corr[sl_i][rep,:,p] = lag_pearsonr(sl_DT, ev_conv[1:],
-                                                        max_lag)
-                peaks[rep] = nearest_peak(lag_corr[sl_i][rep,:,p])
-            peak_shift[sl_i][p] = TR*(peaks[1:].mean(0)-peaks[0])
-
-        # Compute statistics for SLs for Figure 5
-        # if sl_i in [2614, 1479, 1054]:
-        #     nBoot = 100
-        #     bootstrap_rng = default_rng(0)
-        #     boot_peak = np.zeros((nBoot, 6))
-        #     for b in range(nBoot):
-        #         ev_conv = hrf_convolution(ev_annot_freq(bootstrap_rng))
-        #         for rep in range(6):
-        #             sl_DT = get_DTs(pick_data[0][rep])
-        #             boot_lag = lag_pearsonr(sl_DT, ev_conv[1:], max_lag)
-        #             boot_peak[b,rep] = nearest_peak(boot_lag)
-        #     CI_init = TR*(max_lag - np.sort(boot_peak[:,0])[[5,95-1]])
-        #     CI_rep = TR*(max_lag - np.sort(boot_peak[:,1:].mean(1))[[5,95-1]])
-
-        #     print('%d: First Peak CI = %f, Rep Peak CI = %f' %
-        #             (sl_i, CI_init, CI_rep))
+
+    # Compute anticipation and shift in correlation with annotations in
+    # blocks of searchlights, reading the segmentations from the memory map
+    results = open_results(results_path)
+    sl_segs = results['fit_HMM']
+    n_perms = np.array(results['n_perms'][:nSL])
+    sl_AUCdiffs, peak_shift = [], []
+    for sl_start in range(0, nSL, block):
+        sl_block = slice(sl_start, min(sl_start + block, nSL))
+        AUCdiffs, shift = HMM_stats(np.array(sl_segs[sl_block, :nPerm]),
+                                    ev_conv, max_lag, TR)
+        sl_AUCdiffs.append(AUCdiffs)
+        peak_shift.append(shift)
+    sl_AUCdiffs = np.concatenate(sl_AUCdiffs)
+    peak_shift = np.concatenate(peak_shift)
+
+    # Compute statistics for SLs for Figure 5
+    # for sl_i in [2614, 1479, 1054]:
+    #     pick_data = sl_segs[sl_i]
+    #     nBoot = 100
+    #     bootstrap_rng = default_rng(0)
+    #     boot_peak = np.zeros((nBoot, 6))
+    #     for b in range(nBoot):
+    #         ev_conv = hrf_convolution(ev_annot_freq(bootstrap_rng))
+    #         sl_DT = get_DTs(pick_data[0])
+    #         boot_lag = lag_pearsonr(sl_DT, ev_conv[1:], max_lag)
+    #         boot_peak[b] = nearest_peak(boot_lag)
+    #     CI_init = TR*(max_lag - np.sort(boot_peak[:,0])[[5,95-1]])
+    #     CI_rep = TR*(max_lag - np.sort(boot_peak[:,1:].mean(1))[[5,95-1]])
+
+    #     print('%d: First Peak CI = %f, Rep Peak CI = %f' %
+    #             (sl_i, CI_init, CI_rep))
+
+    # Project all maps with the same searchlight -> voxel operator
+    projection = get_vox_projection(SL_allvox, np.count_nonzero(non_nan_mask))
 
     # Create map of shifts in peak correlation with annotations
-    pldiff, pldiff_q = get_vox_map(peak_shift, SL_allvox, non_nan_mask)
-    save_nii(save_path + 'peaklagdiff.nii', header_fpath, pldiff)
-    save_nii(save_path + 'peaklagdiff_q.nii', header_fpath, pldiff_q)
+    pldiff, pldiff_q = get_vox_map(peak_shift, SL_allvox, non_nan_mask,
+                                   projection=projection, n_perms=n_perms)
+    maps = {'peaklagdiff': pldiff, 'peaklagdiff_q': pldiff_q}
 
 
     # Create anticipation maps for each repetition and the average
-    AUCdiff, AUCdiff_q = get_vox_map(sl_AUCdiffs, SL_allvox, non_nan_mask)
+    AUCdiff, AUCdiff_q = get_vox_map(sl_AUCdiffs, SL_allvox, non_nan_mask,
+                                     projection=projection, n_perms=n_perms)
     for i in range(AUCdiff.shape[3]):
-        save_nii(save_path + 'AUCdiff_' + str(i) + '.nii', header_fpath,
-                AUCdiff[:,:,:,i])
-        save_nii(save_path + 'AUCdiff_' + str(i) + '_q.nii', header_fpath,
-                AUCdiff_q[:,:,:,i])
-
-    for sl_i in range(nSL):
-        sl_AUCdiffs[sl_i] = sl_AUCdiffs[sl_i].mean(0)
-    AUCdiff, AUCdiff_q = get_vox_map(sl_AUCdiffs, SL_allvox, non_nan_mask)
-    save_nii(save_path + 'AUCdiff_' + str(i) + '_mean.nii', header_fpath,
-            AUCdiff)
-    save_nii(save_path + 'AUCdiff_' + str(i) + '_mean_q.nii', header_fpath,
-            AUCdiff_q)
+        maps['AUCdiff_' + str(i)] = AUCdiff[:,:,:,i]
+        maps['AUCdiff_' + str(i) + '_q'] = AUCdiff_q[:,:,:,i]
+
+    sl_AUCdiffs = sl_AUCdiffs.mean(1)
+    AUCdiff, AUCdiff_q = get_vox_map(sl_AUCdiffs, SL_allvox, non_nan_mask,
+                                     projection=projection, n_perms=n_perms)
+    maps['AUCdiff_' + str(i) + '_mean'] = AUCdiff
+    maps['AUCdiff_' + str(i) + '_mean_q'] = AUCdiff_q
+
+    # Write all maps at once
+    save_niis(save_path, maps, header_fpath)
 
     # Correlate anticipation with coordinates
     coords_nonnan = np.transpose(np.where(non_nan_mask))
     perm_maps = get_vox_map([sl[:,np.newaxis] for sl in sl_AUCdiffs],
-                            SL_allvox, non_nan_mask, return_q = False)
-
-    AUC_nonnan = perm_maps[non_nan_mask]
-    spear = np.zeros((nPerm, 3))
-    for p in range(nPerm):
+                            SL_allvox, non_nan_mask, return_q = False,
+                            projection=projection)
+
+    # Null correlations only use the permutations that all searchlights have
+    # run, so that no voxel is missing from the permuted maps
+    nPerm_all = min(int(n_perms.min()), nPerm)
+    print('Spearman null from %d permutations' % (nPerm_all - 1))
+    AUC_nonnan = perm_maps[non_nan_mask][:, :nPerm_all]
+    spear = np.zeros((nPerm_all, 3))
+    for p in range(nPerm_all):
         spear[p,:] = spearmanr(AUC_nonnan[:,p], coords_nonnan)[0][0,1:]
     print('Spearman corr w/coords (unmasked) ZYX=', spear[0,:])
     z = (spear[0,:]-spear[1:,:].mean(0))/np.std(spear[1:,:], axis=0)
@@ -231,8 +327,8 @@ def compile_fit_HMM(pickle_path, non_nan_mask, SL_allvox,
     qmask = AUCdiff_q[non_nan_mask] < 0.05
     coords_q05 = coords_nonnan[qmask,:]
     AUC_q05 = AUC_nonnan[qmask,:]
-    spear = np.zeros((nPerm, 3))
-    for p in range(nPerm):
+    spear = np.zeros((nPerm_all, 3))
+    for p in range(nPerm_all):
         spear[p,:] = spearmanr(AUC_q05[:,p], coords_q05)[0][0,1:]
     print('Spearman corr w/coords (q<0.05 masked) ZYX=', spear[0,:])
     z = (spear[0,:]-spear[1:,:].mean(0))/np.std(spear[1:,:], axis=0)
@@ -243,8 +339,8 @@ def compile_fit_HMM(pickle_path, non_nan_mask, SL_allvox,
     K = opt_event
     K_nonnan = K[non_nan_mask]
     K_q05 = K_nonnan[qmask]
-    K_spear = np.zeros(nPerm)
-    for p in range(nPerm):
+    K_spear = np.zeros(nPerm_all)
+    for p in range(nPerm_all):
         K_spear[p] = spearmanr(AUC_q05[:,p], 90/K_q05)[0]
     print('Spearman corr w/K (q<0.05 masked) =', K_spear[0])
     z = (K_spear[0]-K_spear[1:].mean(0))/np.std(K_spear[1:])
@@ -275,14 +371,162 @@ def shift_corr(data_list, max_shift):
 
     return lag_pearsonr(rep1, rep2_6, max_shift)
 
-def compile_shift_corr(pickle_path, non_nan_mask, SL_allvox,
+def shift_corr_stats(lag_corrs, max_lag=10, TR=1.5):
+    """Shift in seconds of the peak of shift_corr lag correlations
+
+    Parameters
+    ----------
+    lag_corrs : ndarray
+        Results of shift_corr, with lags on the last axis (permutations that
+        have not been run are NaN)
+    max_lag : int
+        Maximum lag between initial and repeated viewings
+    TR : float
+        Repetition time in seconds
+
+    Returns
+    -------
+    ndarray
+        Shift of the initial viewing relative to repeated viewings
+    """
+
+    return TR*(max_lag - nearest_peak(lag_corrs))
+
+def run_searchlight(data_list, perms, subjects, max_lag, analyses=None,
+                    K_range=np.arange(2, 10), nFeatures=10, n_events=7,
+                    cache_dir=None, cache_size=2**30):
+    """Run all analyses for a batch of permutations of one searchlight
+
+    Everything that does not depend on the permutation is computed once:
+    the NaN voxels of each rep, the mean over voxels of each rep for
+    shift_corr and the hyperalignment shared between permutations (see
+    fit_HMM). optimal_events only depends on the first rep of each subject,
+    so it is run once for all permutations with the same first reps, and
+    shift_corr is computed for all permutations as stacked arrays.
+
+    If cache_dir is given, results are looked up in and added to an on-disk
+    cache keyed by a hash of the searchlight data, the analysis and its
+    parameters, and the rep orders of each permutation that the analysis
+    depends on, so that only results whose inputs changed are recomputed.
+
+    Parameters
+    ----------
+    data_list : list of ndarrays
+        List of Reps x TRs x Vox arrays for each subject, not permuted
+    perms : ndarray
+        nPerm x nSubj x nReps array of rep orders for each subject
+    subjects : list of strings
+        Names of all subjects
+    max_lag : int
+        Maximum lag for shift_corr
+    analyses : dict, optional
+        Maps each analysis name to the list of permutations to run (defaults
+        to all of them)
+    K_range : ndarray
+        Numbers of events to test in optimal_events
+    nFeatures : int
+        Dimensionality of the hyperaligned shared space in fit_HMM
+    n_events : int
+        Number of events to fit in fit_HMM
+    cache_dir : string, optional
+        Directory of the result cache
+    cache_size : int
+        Maximum size of the result cache in bytes
+
+    Returns
+    -------
+    dict
+        Maps each analysis name to an array of its results for the
+        permutations in analyses
+    """
+
+    if analyses is None:
+        analyses = {name: list(range(len(perms))) for name in
+                    ['optimal_events', 'fit_HMM', 'shift_corr']}
+    if cache_dir is None:
+        return _run_analyses(data_list, perms, subjects, max_lag, analyses,
+                             K_range, nFeatures, n_events)
+
+    # optimal_events only depends on the first rep of each subject
+    digest = data_digest(data_list)
+    params = {'optimal_events': {'K_range': tuple(K_range)},
+              'fit_HMM': {'nFeatures': nFeatures, 'n_events': n_events},
+              'shift_corr': {'max_lag': max_lag}}
+    inputs = {'optimal_events': perms[:, :, :1], 'fit_HMM': perms,
+              'shift_corr': perms}
+
+    # Look up cached results, and run the analyses for the others
+    keys = {}
+    cached = {}
+    with profiling.stage('cache'):
+        for name in analyses:
+            keys[name] = cache_key(digest, name, params[name])
+            cached[name] = cache_load(cache_dir, keys[name],
+                                      inputs[name][analyses[name]])
+    missing = {name: [p for p, c in zip(analyses[name], cached[name])
+                      if c is None] for name in analyses}
+    computed = _run_analyses(data_list, perms, subjects, max_lag, missing,
+                             K_range, nFeatures, n_events)
+
+    results = {}
+    for name in analyses:
+        if missing[name]:
+            with profiling.stage('cache'):
+                cache_store(cache_dir, keys[name],
+                            inputs[name][missing[name]], computed[name],
+                            cache_size)
+        new_results = iter(computed[name])
+        results[name] = np.array([next(new_results) if c is None else c
+                                  for c in cached[name]])
+    return results
+
+def _run_analyses(data_list, perms, subjects, max_lag, analyses, K_range,
+                  nFeatures, n_events):
+    """Run each analysis for its list of permutations, see run_searchlight"""
+
+    nSubj = len(data_list)
+    results = {}
+
+    # Optimal number of events on rep 1, without voxels that have NaNs
+    with profiling.stage('optimal_events', perms=analyses['optimal_events']):
+        nan_vox = np.array([np.any(np.isnan(d), axis=1) for d in data_list])
+        K_cache = {}
+        results['optimal_events'] = np.zeros(
+            len(analyses['optimal_events']), dtype=int)
+        for i, p in enumerate(analyses['optimal_events']):
+            first = perms[p, :, 0]
+            if first.tobytes() not in K_cache:
+                valid = ~np.any(nan_vox[np.arange(nSubj), first], axis=0)
+                rep1 = [d[r][np.newaxis, :, valid]
+                        for d, r in zip(data_list, first)]
+                K_cache[first.tobytes()] = optimal_events(rep1, subjects,
+                                                          K_range=K_range)
+            results['optimal_events'][i] = K_cache[first.tobytes()]
+
+    with profiling.stage('fit_HMM', perms=analyses['fit_HMM']):
+        results['fit_HMM'] = fit_HMM(data_list, perms[analyses['fit_HMM']],
+                                     nFeatures, n_events) \
+                             if analyses['fit_HMM'] else np.array([])
+
+    # Group mean timecourse of each rep, for all permutations at once
+    with profiling.stage('shift_corr', perms=analyses['shift_corr']):
+        vox_means = np.array([d.mean(2) for d in data_list]) # Subj x Rep x TR
+        group_data = vox_means[np.arange(nSubj)[:, np.newaxis],
+                               perms[analyses['shift_corr']]].mean(1)
+        results['shift_corr'] = lag_pearsonr(group_data[:, 0, :],
+                                             group_data[:, 1:, :].mean(1),
+                                             max_lag)
+    return results
+
+def compile_shift_corr(results_path, non_nan_mask, SL_allvox,
                         header_fpath, save_path):
     """Create map of peak of shift_corr
 
     Parameters
     ----------
-    pickle_path : string
-        Filepath to where pickles were saved for each searchlight
+    results_path : string
+        Filepath to where result arrays were merged for all searchlights
+        (see results.merge_results)
     non_nan_mask : ndarray
         3d boolean mask of valid voxels
     SL_allvox : list of ndarrays
@@ -293,28 +537,62 @@ def compile_shift_corr(pickle_path, non_nan_mask, SL_allvox,
         Location of output directory
     """
 
-    nSL = 5247 # 5354
-    nPerm = 3 #100
+    nSL, nPerm = results_size(results_path)
+    assert nSL == len(SL_allvox), \
+        "result arrays do not match the number of searchlights"
     TR = 1.5
     max_lag = 10
 
-    corrshift = nSL * [None]
-    for sl_i in range(nSL):
-        corrshift[sl_i] = np.zeros(nPerm)
-        pickle_fname = '%sshift_corr_%d.p' % (pickle_path, sl_i)
-        pick_data = pickle.load(open(pickle_fname, 'rb'))
+    sl_lag_corrs = load_results(results_path, 'shift_corr', nSL, nPerm)
+    corrshift = shift_corr_stats(sl_lag_corrs, max_lag, TR)
+    n_perms = np.array(open_results(results_path)['n_perms'][:nSL])
+
+    cs, cs_q = get_vox_map(corrshift, SL_allvox, non_nan_mask,
+                           n_perms=n_perms)
+    save_niis(save_path, {'shift_corr': cs,
+                          'shift_corr_q': cs_q}, # q is FDR corrected p values
+              header_fpath)
 
-        for p in range(nPerm):
-            lag_corr = pick_data[p][:]
-            corrshift[sl_i][p] = TR*(max_lag - nearest_peak(lag_corr))
+def get_vox_projection(SL_voxels, nVox):
+    """Sparse operator that averages searchlight results into voxels
 
-        cs, cs_q = get_vox_map(corrshift, SL_allvox, non_nan_mask)
-        save_nii(save_path + 'shift_corr.nii', header_fpath, cs)
-        save_nii(save_path + 'shift_corr_q.nii', header_fpath, cs_q) # q is FDR corrected p values # q is FDR corrected p values
+    Parameters
+    ----------
+    SL_voxels: list
+        Voxel information from searchlight analysis
+    nVox : int
+        Number of valid voxels
 
-def get_vox_map(SL_results, SL_voxels, non_nan_mask, return_q=True):
+    Returns
+    -------
+    csr_matrix
+        nVox x nSL matrix, whose row for each voxel is 1/n in the columns of
+        the n searchlights containing that voxel
+    """
+
+    from scipy.sparse import csr_matrix
+
+    rows = np.concatenate(SL_voxels)
+    cols = np.repeat(np.arange(len(SL_voxels)), [len(sl) for sl in SL_voxels])
+    SLcount = np.bincount(rows, minlength=nVox)
+    return csr_matrix((1 / SLcount[rows], (rows, cols)),
+                      shape=(nVox, len(SL_voxels)))
+
+def get_vox_map(SL_results, SL_voxels, non_nan_mask, return_q=True,
+                projection=None, n_perms=None):
     """Projects searchlight results to voxel maps.
 
+    All maps and permutations are projected with a single sparse matrix
+    product. The projection can be computed once with get_vox_projection
+    and passed in to reuse it across calls.
+
+    If searchlights were stopped early, n_perms gives the number of
+    permutations run in each of them. The null distribution of each voxel
+    then only uses the permutations that all searchlights containing the
+    voxel have run, so that every null map averages the same searchlights
+    as the real map. Voxels with fewer than two such null permutations
+    have no q value.
+
     Parameters
     ----------
     SL_results: list of ndarrays
@@ -325,6 +603,11 @@ def get_vox_map(SL_results, SL_voxels, non_nan_mask, return_q=True):
         3d boolean mask indicating elements containing data
     return_q : boolean
         Whether to compute and return FDR-corrected p values
+    projection : csr_matrix, optional
+        Result of get_vox_projection for SL_voxels
+    n_perms : ndarray, optional
+        Number of permutations run in each searchlight, including the real
+        analysis (defaults to all of them)
 
     Returns
     -------
@@ -335,50 +618,50 @@ def get_vox_map(SL_results, SL_voxels, non_nan_mask, return_q=True):
         Map of q values for each voxel (if return_q=True)
     """
 
-    coords = np.transpose(np.where(non_nan_mask))
-    nVox = coords.shape[0]
-    # if SL_results[0].ndim == 1: # type(SL_results[0]) is list or 
-    #     nMaps = 1
-    #     nPerm = len(SL_results[0])
-    # else:
-    #     nMaps = SL_results[0].shape[0]
-    #     nPerm = SL_results[0].shape[1]
-    nMaps = 1
-    nPerm = 3
-
-    voxel_maps = np.zeros((nMaps, nPerm, nVox))
-    voxel_SLcount = np.zeros(nVox)
-
-    for idx, sl in enumerate(SL_voxels):
-        if nMaps == 1:
-            voxel_maps[0,:,sl] += SL_results[idx]
-        else:
-            for m in range(nMaps):
-                voxel_maps[m,:,sl] += SL_results[idx][m, :]
-        voxel_SLcount[sl] += 1
-
-    nz_vox = voxel_SLcount > 0
-    voxel_maps[:, :, nz_vox] = voxel_maps[:, :, nz_vox] / voxel_SLcount[nz_vox]
+    from scipy.stats import norm
+
+    nVox = np.count_nonzero(non_nan_mask)
+    if np.ndim(SL_results[0]) == 1:
+        nMaps = 1
+        nPerm = len(SL_results[0])
+    else:
+        nMaps, nPerm = np.shape(SL_results[0])
+
+    if projection is None:
+        projection = get_vox_projection(SL_voxels, nVox)
+    SL_results = np.asarray(SL_results, dtype=float).reshape(
+        len(SL_voxels), nMaps * nPerm)
+    voxel_maps = (projection @ SL_results).T.reshape(nMaps, nPerm, nVox)
+
+    nz_vox = projection.getnnz(axis=1) > 0
     voxel_maps[:, :, ~nz_vox] = np.nan
 
+    # Permutations run by all searchlights containing each voxel
+    vox_nperm = np.full(nVox, nPerm)
+    if n_perms is not None:
+        vox_nperm[nz_vox] = np.minimum.reduceat(
+            np.minimum(n_perms, nPerm)[projection.indices],
+            projection.indptr[:-1][nz_vox])
+        voxel_maps[:, np.arange(nPerm)[:, np.newaxis] >= vox_nperm] = np.nan
+
     vox3d = np.full(non_nan_mask.shape + (nMaps,), np.nan)
     vox3d[non_nan_mask,:] = voxel_maps[:,0,:].T
 
     if not return_q:
         return vox3d.squeeze()
 
-    null_means = voxel_maps[:, 1:, nz_vox].mean(1)
-    null_stds = np.std(voxel_maps[:, 1:, nz_vox], axis=1)
+    tested = nz_vox & (vox_nperm > 2)
+    null_means = np.nanmean(voxel_maps[:, 1:, tested], axis=1)
+    null_stds = np.nanstd(voxel_maps[:, 1:, tested], axis=1)
 
-    z = (voxel_maps[:, 0, nz_vox] - null_means)/null_stds
-    p = norm.sf(z)
-    q = np.zeros(p.shape)
-    for m in range(nMaps):
-        q[m,:] = FDR_p(p[m,:])
+    z = np.full((nMaps, nVox), np.nan)
+    z[:, tested] = (voxel_maps[:, 0, tested] - null_means)/null_stds
+    q = np.full((nMaps, nVox), np.nan)
+    q[:, tested] = FDR_p(norm.sf(z[:, tested]))
 
     z3d = np.full(non_nan_mask.shape + (nMaps,), np.nan)
     z3d[non_nan_mask,:] = z.T
     q3d = np.full(non_nan_mask.shape + (nMaps,), np.nan)
     q3d[non_nan_mask,:] = q.T
 
-    return vox3d.squeeze(), q3d.squeeze()
\ No newline at end of file
+    return vox3d.squeeze(), q3d.squeeze()
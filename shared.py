@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import numpy as np
+from numpy.lib.format import open_memmap
+
+STORE_ARRAYS = ['SL_ptr', 'SL_vox', 'subjects']
+
+
+def _manifest(store_fpath, cond):
+    """Identifies the store file and condition that a directory holds"""
+
+    stat = os.stat(store_fpath)
+    return {'store': os.path.abspath(store_fpath), 'size': stat.st_size,
+            'mtime': stat.st_mtime, 'cond': cond}
+
+
+def publish_store(store_fpath, shared_dir, cond='IN', block=8):
+    """Copy a searchlight store into memory-mapped arrays shared by a node
+
+    The data of one condition and the searchlight voxel table are written
+    once into .npy files in shared_dir (e.g. under /dev/shm, which is kept
+    in memory), which every worker process then maps with open_store. The
+    pages are shared between processes, so the memory of a node does not
+    grow with the number of workers. A directory that already holds the
+    same store (path, size and modification time) and condition is reused.
+
+    Each file is written under a temporary name and renamed into place, and
+    the manifest is written last, so that processes of the same node can
+    publish concurrently and never map a partial file.
+
+    Parameters
+    ----------
+    store_fpath : string
+        Searchlight store written by save_s_lights
+    shared_dir : string
+        Directory to publish the arrays in
+    cond : string, optional
+        Condition to publish ('IN', 'SF' or 'SR')
+    block : int
+        Number of subjects copied at a time
+
+    Returns
+    -------
+    bool
+        True if the store was copied, False if it was already published
+    """
+
+    import tables
+
+    manifest = _manifest(store_fpath, cond)
+    manifest_fpath = os.path.join(shared_dir, 'manifest.json')
+    try:
+        with open(manifest_fpath) as f:
+            if json.load(f) == manifest:
+                return False
+    except (OSError, ValueError):
+        pass
+
+    # Invalidate an older store before replacing its arrays
+    os.makedirs(shared_dir, exist_ok=True)
+    try:
+        os.remove(manifest_fpath)
+    except FileNotFoundError:
+        pass
+
+    tmp = '.%d.tmp' % os.getpid()
+    with tables.open_file(store_fpath, mode='r') as h5file:
+        for name in STORE_ARRAYS:
+            fname = os.path.join(shared_dir, name + '.npy')
+            with open(fname + tmp, 'wb') as f:
+                np.save(f, h5file.get_node('/', name).read())
+            os.replace(fname + tmp, fname)
+
+        node = h5file.get_node('/', cond) # Subj x Vox x Reps x TRs
+        fname = os.path.join(shared_dir, cond + '.npy')
+        out = open_memmap(fname + tmp, mode='w+', dtype=node.dtype,
+                          shape=tuple(int(n) for n in node.shape))
+        for s in range(0, node.shape[0], block):
+            out[s:s + block] = node[s:s + block]
+        out.flush()
+        del out
+        os.replace(fname + tmp, fname)
+
+    with open(manifest_fpath + tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_fpath + tmp, manifest_fpath)
+    return True
+
+
+def open_store(shared_dir):
+    """Map the arrays published by publish_store, without copying them
+
+    Parameters
+    ----------
+    shared_dir : string
+        Directory the store was published in
+
+    Returns
+    -------
+    dict
+        Read-only memory-mapped arrays of the published condition (with its
+        name as key), the searchlight voxel table ('SL_ptr', 'SL_vox') and
+        the subject names ('subjects'), which load_s_light accepts in place
+        of the HDF5 store
+    """
+
+    with open(os.path.join(shared_dir, 'manifest.json')) as f:
+        cond = json.load(f)['cond']
+    return {name: np.load(os.path.join(shared_dir, name + '.npy'),
+                          mmap_mode='r')
+            for name in STORE_ARRAYS + [cond]}
+
+
+def unpublish_store(shared_dir):
+    """Remove a published store
+
+    Processes that have already mapped the arrays keep their views; the
+    memory is released once they are unmapped.
+
+    Parameters
+    ----------
+    shared_dir : string
+        Directory the store was published in
+    """
+
+    shutil.rmtree(shared_dir, ignore_errors=True)
@@ -1,11 +1,8 @@
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
-import pandas as pd
-import pandas as pd
-import nibabel as nib
-from scipy.stats import pearsonr, zscore
-from brainiak.eventseg.event import EventSegment
-from brainiak.funcalign.srm import DetSRM
+from numpy.random import default_rng
+from hmm import fit_events, find_events, zscore
 
 def nearest_peak(v):
     """Estimates location of local maximum nearest the origin
@@ -15,78 +12,218 @@ def nearest_peak(v):
     two surrounding points, and the peak of this function is used as a
     continuous-valued estimate of the location of the maximum.
 
+    All curves in a stacked array climb together, one step per iteration,
+    for at most as many steps as there are lags (a curve with a flat top
+    could otherwise step back and forth forever).
+
     Parameters
     ----------
     v : ndarray
-        Array of values from [-max_lag, max_lag] inclusive
+        Array of values from [-max_lag, max_lag] inclusive, or an array of
+        such curves with lags on the last axis
 
     Returns
     -------
-    float
-        Location of peak of quadratic fit
+    float or ndarray
+        Location of peak of quadratic fit, for each curve
     """
 
-    lag = (len(v)-1)//2
+    v = np.asarray(v)
+    nLags = v.shape[-1]
+    curves = v.reshape(-1, nLags)
+    rows = np.arange(curves.shape[0])
+
+    lag = np.full(curves.shape[0], (nLags-1)//2)
 
     # Find local maximum
-    while 2 <= lag <= (len(v) - 3):
-        win = v[(lag-1):(lag+2)]
-        if (win[1] > win[0]) and (win[1] > win[2]):
+    climbing = np.ones(curves.shape[0], dtype=bool)
+    for _ in range(nLags):
+        climbing &= (2 <= lag) & (lag <= (nLags - 3))
+        if not np.any(climbing):
             break
-        if win[0] > win[2]:
-            lag -= 1
-        else:
-            lag += 1
+        win = [curves[rows, lag-1], curves[rows, lag], curves[rows, lag+1]]
+        climbing &= ~((win[1] > win[0]) & (win[1] > win[2]))
+        lag[climbing] += np.where(win[0] > win[2], -1, 1)[climbing]
 
     # Quadratic fit
     x = [lag-1, lag, lag+1]
-    y = v[(lag-1):(lag+2)]
+    y = [curves[rows, lag-1], curves[rows, lag], curves[rows, lag+1]]
     denom = (x[0] - x[1]) * (x[0] - x[2]) * (x[1] - x[2])
     A = (x[2] * (y[1] - y[0]) + x[1] * \
          (y[0] - y[2]) + x[0] * (y[2] - y[1])) / denom
     B = (x[2]*x[2] * (y[0] - y[1]) + x[1]*x[1] * (y[2] - y[0]) + \
          x[0]*x[0] * (y[1] - y[2])) / denom
 
-    max_x = (-B / (2*A))
-    return min(max(max_x, 0), len(v)-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        max_x = (-B / (2*A))
+    max_x = np.minimum(np.maximum(max_x, 0), nLags-1)
+    return max_x.reshape(v.shape[:-1])[()]
 
-def hyperalign(subj_list, nFeatures=10):
+def hyperalign(subj_list, nFeatures=10, perms=None):
     """Perform hyperaligment with SRM
 
     Given a list of data across subjects, concatenate across conditions and
     then run SRM to map all subjects into a shared space. The data is
     then divided back into conditions and z-scored.
 
+    If perms is given, the data is hyperaligned for each permutation of the
+    reps. Voxels and subjects are pruned once for all permutations, and SRM
+    is only fit once for permutations that reorder the reps of all subjects
+    in the same way (see shared_reorderings), since SRM does not depend on
+    the order of the timepoints; the shared responses of the others are
+    reindexed from the first permutation fit.
+
     Parameters
     ----------
     subj_list : list of ndarrays
         List of a Reps x TRs x Vox array for each subject
     nFeatures : int
         Dimensionality of shared space
+    perms : ndarray, optional
+        nPerm x nSubj x nReps array of rep orders for each subject
 
     Returns
     -------
     list of ndarrays
-        List of a Reps x TRs x nFeatures array for each subject
+        List of a Reps x TRs x nFeatures array for each subject, or a list
+        of these lists for each permutation if perms is given
     """
 
-    nReps = subj_list[0].shape[0]
-    nTRs = subj_list[0].shape[1]
-
     # Remove voxels that are all 0
     subj_list = [d[:,:,np.all(~np.all(d == 0, axis=1), axis=0)]
                 for d in subj_list]
     # Remove any subjects with fewer voxels than nFeatures
-    subj_list = [d for d in subj_list if d.shape[2] >= nFeatures]
+    keep = [i for i, d in enumerate(subj_list) if d.shape[2] >= nFeatures]
+    subj_list = [subj_list[i] for i in keep]
+
+    if perms is None:
+        return _srm_shared(subj_list, nFeatures)
+
+    perms = np.asarray(perms)[:, keep]
+    base, orders = shared_reorderings(perms)
+    shared = []
+    for p in range(perms.shape[0]):
+        if base[p] == p:
+            shared.append(_srm_shared([d[perms[p, i]] for i, d in
+                                       enumerate(subj_list)], nFeatures))
+        else:
+            shared.append([d[orders[p]] for d in shared[base[p]]])
+    return shared
+
+def _srm_shared(subj_list, nFeatures):
+    """Fit SRM to Reps x TRs x Vox arrays and return z-scored shared data"""
+
+    nReps = subj_list[0].shape[0]
+    nTRs = subj_list[0].shape[1]
 
     subj_list = [d.T.reshape(d.shape[-1], nTRs*nReps) for d in subj_list]
-    srm = DetSRM(features=nFeatures)
-    srm.fit(subj_list)
-    shared = srm.transform(subj_list)
+    w, _ = det_srm(subj_list, nFeatures)
+    shared = [w_subj.T.dot(d) for w_subj, d in zip(w, subj_list)]
     shared = [zscore(d.reshape(d.shape[0], nTRs, nReps), axis=1, ddof=1).T
             for d in shared]
     return shared
 
+def det_srm(subj_list, nFeatures=10, n_iter=10, rand_seed=0):
+    """Deterministic Shared Response Model
+
+    Same algorithm, initialization and random seeds as brainiak's DetSRM,
+    so that float64 data gives the same result, but computed in the dtype
+    of the data (e.g. float32).
+
+    Parameters
+    ----------
+    subj_list : list of ndarrays
+        List of a Vox x Samples array for each subject
+    nFeatures : int
+        Dimensionality of shared space
+    n_iter : int
+        Number of iterations
+    rand_seed : int
+        Seed for the random orthogonal initial transforms
+
+    Returns
+    -------
+    list of ndarrays
+        Vox x nFeatures orthogonal transform for each subject
+
+    ndarray
+        nFeatures x Samples shared response
+    """
+
+    if len(subj_list) <= 1:
+        raise ValueError("There are not enough subjects "
+                         "({0:d}) to train the model.".format(len(subj_list)))
+    if subj_list[0].shape[1] < nFeatures:
+        raise ValueError("There are not enough samples to train the model "
+                         "with {0:d} features.".format(nFeatures))
+    if not all(np.all(np.isfinite(d)) for d in subj_list):
+        raise ValueError("Input contains NaN or infinity.")
+    dtype = np.result_type(*subj_list)
+
+    # Random orthogonal initial transforms, one random state per subject
+    random_state = np.random.RandomState(rand_seed)
+    random_states = [np.random.RandomState(random_state.randint(
+        2 ** 32, dtype=np.int64)) for d in subj_list]
+    w = [np.linalg.qr(rs.random_sample((d.shape[0], nFeatures)))[0]
+         .astype(dtype) for rs, d in zip(random_states, subj_list)]
+
+    def shared_response(w):
+        s = np.zeros((nFeatures, subj_list[0].shape[1]), dtype=dtype)
+        for w_subj, d in zip(w, subj_list):
+            s = s + w_subj.T.dot(d)
+        s /= len(w)
+        return s
+
+    s = shared_response(w)
+    for iteration in range(n_iter):
+        for subj, d in enumerate(subj_list):
+            a_subj = d.dot(s.T)
+            perturbation = np.zeros(a_subj.shape, dtype=dtype)
+            np.fill_diagonal(perturbation, 0.001)
+            u_subj, _, v_subj = np.linalg.svd(a_subj + perturbation,
+                                              full_matrices=False)
+            w[subj] = u_subj.dot(v_subj)
+        s = shared_response(w)
+    return w, s
+
+def shared_reorderings(perms):
+    """Find permutations that reorder the reps of all subjects the same way
+
+    Permutation q is a shared reordering of permutation b if there is a
+    single rep order o with perms[q, s] == perms[b, s][o] for every subject
+    s, so that the permuted data of q is the permuted data of b with its
+    reps reordered by o. Permutations that shuffle each subject
+    independently (as in get_perms) are almost never shared reorderings of
+    each other, and are then all their own base.
+
+    Parameters
+    ----------
+    perms : ndarray
+        nPerm x nSubj x nReps array of rep orders for each subject
+
+    Returns
+    -------
+    ndarray
+        Index of the first permutation that each permutation is a shared
+        reordering of (its own index if there is none before it)
+
+    ndarray
+        nPerm x nReps array of rep orders o that take the data of the base
+        permutation to the data of each permutation
+    """
+
+    perms = np.asarray(perms)
+    inv_first = np.argsort(perms[:, 0], axis=1)
+
+    # Orders relative to the first subject are the same for all permutations
+    # that are shared reorderings of each other
+    rel_orders = np.take_along_axis(perms, inv_first[:, np.newaxis, :], axis=2)
+    first_perm = {}
+    base = np.array([first_perm.setdefault(rel.tobytes(), p)
+                     for p, rel in enumerate(rel_orders)])
+    orders = np.take_along_axis(inv_first[base], perms[:, 0], axis=1)
+    return base, orders
+
 def heldout_ll(data, n_events, split):
     """Compute log-likelihood on heldout subjects
 
@@ -111,22 +248,100 @@ def heldout_ll(data, n_events, split):
         Average of log-likelihoods on testing groups
     """
 
-    d = deepcopy(data)
+    return heldout_ll_sweep(data, [n_events], split)[0]
+
+def heldout_ll_sweep(data, K_range, split, n_jobs=None, warm_start=False):
+    """Compute log-likelihood on heldout subjects for many numbers of events
+
+    Gives the same result as calling heldout_ll for each number of events,
+    but removes the NaN voxels and computes the group means only once, and
+    fits the models for all numbers of events and both training groups as
+    one batch. The batch can be split across a pool of n_jobs threads.
+
+    With warm_start, each model is instead initialized from the model with
+    the previous number of events trained on the same group, by splitting
+    its longest event in two. The numbers of events are then fit one after
+    another, and can converge to a different solution than fitting from
+    scratch.
+
+    Parameters
+    ----------
+    data : ndarray
+        subj x TR x Voxels data array
+    K_range : ndarray
+        Numbers of events for event segmentation models, in increasing order
+    split : ndarray
+        Boolean vector, subj in one group are True and in the other are False
+    n_jobs : int, optional
+        Number of threads to fit models in (defaults to fitting serially)
+    warm_start : boolean
+        Whether to initialize each model from the previous number of events
+
+    Returns
+    -------
+    ndarray
+        Average of log-likelihoods on testing groups for each K in K_range
+    """
+
+    d = np.asarray(data)
 
     # Remove nan voxels
-    nan_idxs = np.where(np.isnan(d))
-    nan_idxs = list(set(nan_idxs[2]))
-    d = np.delete(np.asarray(d), nan_idxs, axis=2)
+    d = np.ascontiguousarray(d[:, :, ~np.any(np.isnan(d), axis=(0, 1))])
 
     # Train and test event segmentation across groups
-    group1 = d[split].mean(0)
-    group2 = d[~split].mean(0)
-    es = EventSegment(n_events).fit(group1)
-    _, ll12 = es.find_events(group2)
-    es = EventSegment(n_events).fit(group2)
-    _, ll21 = es.find_events(group1)
+    train = np.array([d[split].mean(0), d[~split].mean(0)])
+    test = train[::-1]
+    nK = len(K_range)
+
+    if warm_start:
+        ll = np.zeros((2, nK))
+        segments = None
+        for i, K in enumerate(K_range):
+            init_seg = None
+            if segments is not None:
+                init_seg = np.array([[_split_longest_event(seg[0], K)]
+                                     for seg in segments])
+            segments, event_pat, event_var = fit_events(
+                train[:, np.newaxis], K, init_seg=init_seg)
+            ll[:, i] = find_events(test, event_pat, event_var, K)[1]
+        return ll.mean(0)
+
+    # Models for each group and number of events
+    n_events = np.tile(K_range, 2)
+    train = np.repeat(train, nK, axis=0)
+    test = np.repeat(test, nK, axis=0)
+
+    def fit_ll(models):
+        _, event_pat, event_var = fit_events(train[models, np.newaxis],
+                                             n_events[models])
+        return find_events(test[models], event_pat, event_var,
+                           n_events[models])[1]
+
+    batches = np.array_split(np.arange(2*nK), n_jobs or 1)
+    if n_jobs is None:
+        ll = np.concatenate([fit_ll(models) for models in batches])
+    else:
+        with ThreadPoolExecutor(n_jobs) as pool:
+            ll = np.concatenate(list(pool.map(fit_ll, batches)))
+
+    return ll.reshape(2, nK).mean(0)
+
+def _split_longest_event(seg, n_events):
+    """Hard segmentation into n_events by splitting the longest event of seg
+
+    Returns a uniform segmentation if seg does not give n_events non-empty
+    events.
+    """
 
-    return (ll12 + ll21)/2
+    events = np.argmax(seg, axis=1)
+    longest = np.argmax(np.bincount(events))
+    longest_trs = np.flatnonzero(events == longest)
+
+    new_events = events + (events > longest)
+    new_events[longest_trs[len(longest_trs)//2:]] += 1
+    if len(np.unique(new_events)) < n_events:
+        return np.ones((len(events), n_events))
+    return np.eye(n_events)[new_events]
 
 def tj_fit(data, n_events=7):
     """Jointly fits HMM to multiple trials (repetitions)
@@ -134,41 +349,46 @@ def tj_fit(data, n_events=7):
     Parameters
     ----------
     data : ndarray
-        Data dimensions: Repetition x TR x Voxels
+        Data dimensions: Repetition x TR x Voxels, or Models x Repetition x
+        TR x Voxels to fit several models at once
     n_events : int
         Number of events to fit
 
     Returns
     -------
     list of ndarrays
-        Resulting segmentations from model fit
+        Resulting segmentations from model fit, or a Models x Repetition x
+        TR x Events array of segmentations if several models are fit
     """
 
-    d = deepcopy(data)
-    d = np.asarray(d)
+    d = np.asarray(data)
+    if d.ndim == 4:
+        nan_vox = np.any(np.isnan(d), axis=(1, 2))
+        if np.any(nan_vox != nan_vox[0]):
+            return np.array([tj_fit(model, n_events) for model in d])
+        return fit_events(d[:, :, :, ~nan_vox[0]], n_events)[0]
 
     nan_idxs = np.where(np.isnan(d))
     nan_idxs = list(set(nan_idxs[2]))
 
     d = np.delete(np.asarray(d), nan_idxs, axis=2)
 
-    ev_obj = EventSegment(n_events).fit(list(d))
-
-    return ev_obj.segments_
+    return list(fit_events(d[np.newaxis], n_events)[0][0])
 
 
 def get_AUCs(segs):
     """Computes the Area Under the Curve for HMM segmentations
 
-    Takes a list of HMM segmentations (each a time x event ndarray of the
-    probability of being in each event at each timepoint) and computes the
-    expected value of the event number at each timepoint, then sums across
-    timepoints to yield the area under this curve.
+    Takes HMM segmentations (each a time x event ndarray of the probability
+    of being in each event at each timepoint) and computes the expected
+    value of the event number at each timepoint, then sums across timepoints
+    to yield the area under this curve. Segmentations can be stacked on any
+    number of leading axes (e.g. perms x reps x time x event).
 
     Parameters
     ----------
-    segs : list of ndarrays
-        Time x event probabilities from HMM segmentations
+    segs : ndarray
+        ... x Time x event probabilities from HMM segmentations
 
     Returns
     -------
@@ -177,99 +397,183 @@ def get_AUCs(segs):
 
     """
 
-    auc = [round(np.dot(segs[rep], np.arange(segs[rep].shape[1])).sum(), 2)
-        for rep in range(len(segs))]
+    segs = np.asarray(segs)
 
-    return np.asarray(auc)
+    return np.round((segs @ np.arange(segs.shape[-1])).sum(-1), 2)
 
 
 def FDR_p(pvals):
     """Port of AFNI mri_fdrize.c
 
-    Computes False Discovery Rate thresholds (q) for a set of p values
+    Computes False Discovery Rate thresholds (q) for a set of p values. The
+    step-up q values are computed for all maps at once, as a reverse
+    cumulative minimum over the sorted p values, and pvals is not modified.
 
     Parameters
     ----------
     pvals : ndarray
-        p values
+        p values, either a vector or a maps x tests array (each row is
+        corrected separately)
 
     Returns
     -------
     ndarray
-        q values
+        q values, with the same shape as pvals
     """
 
     assert np.all(pvals >= 0) and np.all(pvals <= 1)
-    pvals[pvals < np.finfo(np.float_).eps] = np.finfo(np.float_).eps
-    pvals[pvals == 1] = 1-np.finfo(np.float_).eps
-    n = pvals.shape[0]
-
-    qvals = np.zeros((n))
-    sorted_ind = np.argsort(pvals)
-    sorted_pvals = pvals[sorted_ind]
-    qmin = 1.0
-    for i in range(n-1, -1, -1):
-        qval = (n * sorted_pvals[i])/(i+1)
-        if qval > qmin:
-            qval = qmin
-        else:
-            qmin = qval
-        qvals[sorted_ind[i]] = qval
+    eps = np.finfo(np.float64).eps
+    shape = np.shape(pvals)
+    pvals = np.atleast_2d(pvals)
+    pvals = np.where(pvals < eps, eps, pvals)
+    pvals[pvals == 1] = 1-eps
+    n = pvals.shape[1]
+
+    sorted_ind = np.argsort(pvals, axis=1)
+    sorted_pvals = np.take_along_axis(pvals, sorted_ind, axis=1)
+    sorted_qvals = (n * sorted_pvals)/np.arange(1, n+1)
+    sorted_qvals = np.minimum.accumulate(sorted_qvals[:, ::-1],
+                                         axis=1)[:, ::-1]
+    qvals = np.empty(pvals.shape)
+    np.put_along_axis(qvals, sorted_ind, np.minimum(sorted_qvals, 1.0), axis=1)
 
     # Estimate number of true positives m1 and adjust q
     if n >= 233:
-        phist = np.histogram(pvals, bins=20, range=(0, 1))[0]
-        sorted_phist = np.sort(phist[3:19])
-        if np.sum(sorted_phist) >= 160:
-            median4 = n - 20*np.dot(np.array([1, 2, 2, 1]),
-                                    sorted_phist[6:10])/6
-            median6 = n - 20*np.dot(np.array([1, 2, 2, 2, 2, 1]),
-                                    sorted_phist[5:11])/10
-            m1 = min(median4, median6)
+        edges = np.linspace(0, 1, 21)
+        bins = np.minimum(np.searchsorted(edges, pvals, side='right') - 1, 19)
+        bins += 20*np.arange(pvals.shape[0])[:, np.newaxis]
+        phist = np.bincount(bins.ravel(),
+                            minlength=bins.shape[0]*20).reshape(-1, 20)
+        sorted_phist = np.sort(phist[:, 3:19], axis=1)
+        median4 = n - 20*np.dot(sorted_phist[:, 6:10],
+                                np.array([1, 2, 2, 1]))/6
+        median6 = n - 20*np.dot(sorted_phist[:, 5:11],
+                                np.array([1, 2, 2, 2, 2, 1]))/10
+        m1 = np.minimum(median4, median6)
+
+        qfac = (n - m1)/n
+        qfac = np.where(qfac < 0.5, 0.25 + qfac**2, qfac)
+        qfac[np.sum(sorted_phist, axis=1) < 160] = 1
+        qvals *= qfac[:, np.newaxis]
+
+    return qvals.reshape(shape)
+
+def perm_p_interval(stats, conf=0.99):
+    """Clopper-Pearson interval of one-sided permutation p values
+
+    The p value of each statistic is the probability that a null
+    permutation is at least as large as the real one. The number of
+    exceedances among the computed null permutations is binomial, which
+    gives an exact confidence interval for this probability.
+
+    Parameters
+    ----------
+    stats : ndarray
+        nPerm x ... array of statistics, the first is the real (non-permuted)
+        analysis and permutations that have not been run are NaN
+    conf : float
+        Confidence level of the interval
+
+    Returns
+    -------
+    ndarray
+        Lower bounds of the p values
+
+    ndarray
+        Upper bounds of the p values
+    """
 
-            qfac = (n - m1)/n
-            if qfac < 0.5:
-                qfac = 0.25 + qfac**2
-            qvals *= qfac
+    from scipy.stats import beta
 
-    return qvals
+    stats = np.asarray(stats, dtype=float)
+    null = stats[1:]
+    n = np.sum(~np.isnan(null), axis=0)
+    k = np.sum(null >= stats[0], axis=0)
 
+    tail = (1 - conf)/2
+    with np.errstate(invalid='ignore'):
+        lower = np.where(k > 0, beta.ppf(tail, k, n - k + 1), 0)
+        upper = np.where(k < n, beta.ppf(1 - tail, k + 1, n - k), 1)
+    return lower, upper
 
 def lag_pearsonr(x, y, max_lags):
     """Compute lag correlation between x and y, up to max_lags
 
+    The correlation at each lag uses only the overlapping part of the two
+    arrays, as with pearsonr on the trimmed arrays. The sums over each
+    overlap are computed for all lags at once, with cumulative sums for the
+    means and variances and an FFT for the cross products, and stacked
+    arrays (e.g. reps x perms x time) are handled in one call.
+
     Parameters
     ----------
     x : ndarray
-        First array of values
+        First array of values, with time on the last axis
     y : ndarray
-        Second array of values
+        Second array of values, with time on the last axis (must broadcast
+        with x)
     max_lags: int
         Largest lag (must be less than half the length of shortest array)
 
     Returns
     -------
     ndarray
-        Array of 1 + 2*max_lags lag correlations, for x left shifted by
-        max_lags to x right shifted by max_lags
+        Array of 1 + 2*max_lags lag correlations (on the last axis), for x
+        left shifted by max_lags to x right shifted by max_lags
     """
 
-    assert max_lags < min(len(x), len(y)) / 2, \
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    assert max_lags < min(x.shape[-1], y.shape[-1]) / 2, \
         "max_lags exceeds half the length of shortest array"
 
-    assert len(x) == len(y), "array lengths are not equal"
+    assert x.shape[-1] == y.shape[-1], "array lengths are not equal"
+
+    T = x.shape[-1]
+    lags = np.arange(-max_lags, max_lags + 1)
+    n = T - np.abs(lags)
+
+    # Centering does not change the correlations, but keeps the sums small
+    x = x - x.mean(-1, keepdims=True)
+    y = y - y.mean(-1, keepdims=True)
 
-    lag_corrs = np.full(1 + (max_lags * 2), np.nan)
+    # Overlap of x and y when x is right shifted by each lag
+    x_start = np.maximum(-lags, 0)
+    x_end = T - np.maximum(lags, 0)
+    y_start = np.maximum(lags, 0)
+    y_end = T - np.maximum(-lags, 0)
 
-    for i in range(max_lags + 1):
+    def window_sums(v, start, end):
+        cum_v = np.cumsum(v, axis=-1)
+        cum_v = np.concatenate((np.zeros(v.shape[:-1] + (1,)), cum_v), -1)
+        return cum_v[..., end] - cum_v[..., start]
 
-        # add correlations where x is shifted to the right
-        lag_corrs[max_lags + i] = pearsonr(x[:len(x) - i], y[i:len(y)])[0]
+    sum_x = window_sums(x, x_start, x_end)
+    sum_x2 = window_sums(x**2, x_start, x_end)
+    sum_y = window_sums(y, y_start, y_end)
+    sum_y2 = window_sums(y**2, y_start, y_end)
 
-        # add correlations where x is shifted to the left
-        lag_corrs[max_lags - i] = pearsonr(x[i:len(x)], y[:len(y) - i])[0]
+    # sum_xy[lag] = sum over t of x[t] * y[t + lag]
+    nfft = 2 * T
+    sum_xy = np.fft.irfft(np.conj(np.fft.rfft(x, nfft)) * np.fft.rfft(y, nfft),
+                          nfft)[..., lags % nfft]
 
-    return lag_corrs
+    cov = sum_xy - sum_x * sum_y / n
+    var_x = sum_x2 - sum_x**2 / n
+    var_y = sum_y2 - sum_y**2 / n
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lag_corrs = cov / np.sqrt(var_x * var_y)
+
+    # A window in which x or y is constant has no correlation, as with
+    # pearsonr, but its variance is only zero up to the rounding error of
+    # the cumulative sums, which scales with the sum of squares of the array
+    tol = 2 * T * np.finfo(np.float64).eps
+    constant = (var_x <= tol * (x**2).sum(-1, keepdims=True)) | \
+               (var_y <= tol * (y**2).sum(-1, keepdims=True))
+    lag_corrs = np.where(constant, np.nan, lag_corrs)
+
+    return np.clip(lag_corrs, -1, 1)
 
 
 def ev_annot_freq(bootstrap_rng=None):
@@ -347,20 +651,66 @@ def get_DTs(ev_seg):
     Parameters
     ----------
     ev_seg : ndarray
-        Time x event probability from an HMM segmentation
+        ... x Time x event probability from HMM segmentations, stacked on any
+        number of leading axes
 
     Returns
     -------
-    list
-        Diff in expected event number between successive pairs of timepoints
+    ndarray
+        ... x Time-1 diff in expected event number between successive pairs
+        of timepoints
     """
 
-    nTR = ev_seg.shape[0]
-    n_events = ev_seg.shape[1]
+    ev_seg = np.asarray(ev_seg)
 
-    evs = np.dot(ev_seg, np.arange(n_events))
+    evs = ev_seg @ np.arange(ev_seg.shape[-1])
 
-    return [(evs[tr + 1] - evs[tr]) / ((tr + 1) - tr) for tr in range(nTR - 1)]
+    return np.diff(evs, axis=-1)
+
+def get_perms(nSubj, nPerm, nReps=6, seed=0):
+    """Rep orders for the real analysis and each permutation
+
+    Permutation 0 is the real (non-permuted) order. In every other
+    permutation the reps of each subject are shuffled independently, drawing
+    from default_rng(seed) one subject at a time, so the first permutations
+    are unchanged when nPerm is increased.
+
+    Parameters
+    ----------
+    nSubj : int
+        Number of subjects
+    nPerm : int
+        Number of permutations, including the real analysis
+    nReps : int
+        Number of repetitions
+    seed : int
+        Seed for the random number generator
+
+    Returns
+    -------
+    ndarray
+        nPerm x nSubj x nReps array of rep indices
+    """
+
+    rng = default_rng(seed)
+    perms = np.empty((nPerm, nSubj, nReps), dtype=int)
+    for p in range(nPerm):
+        for s in range(nSubj):
+            if p == 0:
+                # This is the real (non-permuted) analysis
+                perms[p, s] = np.arange(nReps)
+            else:
+                perms[p, s] = rng.permutation(nReps)
+    return perms
+
+@lru_cache()
+def _load_template(header_fpath):
+    """Affine and header of a template nifti file, loaded once per file"""
+
+    import nibabel as nib
+
+    img = nib.load(header_fpath)
+    return img.affine, img.header
 
 def save_nii(new_fpath, header_fpath, data):
     """Save data into a nifti file, using header from an existing file
@@ -370,46 +720,83 @@ def save_nii(new_fpath, header_fpath, data):
     new_fpath : string
         File to save to
     header_fpath : string
-        File to copy header information from
+        File to copy header information from (read only once per file)
     data : ndarray
-        3d voxel data (will be transposed to become x/y/z)
+        3d voxel data (will be transposed to become x/y/z), or a 4d stack of
+        such volumes on the last axis
     """
-    img = nib.load(header_fpath)
-    new_img = nib.Nifti1Image(data.T, img.affine, img.header)
+    import nibabel as nib
+
+    affine, header = _load_template(header_fpath)
+    new_img = nib.Nifti1Image(np.swapaxes(data, 0, 2), affine, header)
     nib.save(new_img, new_fpath)
 
-def save_clip_nii(fpath, tsv_fpath, cond='All'):
-    """Open and cut fmri image into clips for each subject & run, based on the associated tsv file
+def save_niis(save_path, maps, header_fpath, compress=False, n_jobs=None):
+    """Save a set of named maps into nifti files, writing them in parallel
 
     Parameters
     ----------
-    sub-value : string
-        The subject that is being used (example sub-01)
-    run : int
-        Which run is being processed (example, 1 for run-01)
-    cond : string
-        The cond that should be chosen from the sliced data
+    save_path : string
+        Location of output directory
+    maps : dict
+        Map of file name (without extension) to 3d voxel data, or to a 4d
+        stack of volumes saved as a single file (see save_nii)
+    header_fpath : string
+        File to copy header information from
+    compress : boolean
+        Whether to save gzipped maps (.nii.gz) or uncompressed maps (.nii)
+    n_jobs : int, optional
+        Number of threads writing maps (defaults to ThreadPoolExecutor's)
 
     Returns
+    -------
+    list
+        Paths of the saved files
+    """
+
+    ext = '.nii.gz' if compress else '.nii'
+    fpaths = [save_path + name + ext for name in maps]
+    with ThreadPoolExecutor(n_jobs) as pool:
+        list(pool.map(save_nii, fpaths, len(fpaths) * [header_fpath],
+                      maps.values()))
+    return fpaths
+
+def save_clip_nii(fpath, tsv_fpath, cond='All', compress=True):
+    """Open and cut fmri image into clips for each subject & run, based on the associated tsv file
+
+    Only the volumes of each clip are read, by slicing the image's array
+    proxy rather than loading the whole run. The file is kept open and the
+    clips are read in order of onset, so that a compressed run is
+    decompressed once.
+
+    Parameters
     ----------
-    clips : list of ndarray
-        Each ndarray represents a clip
+    fpath : string
+        Preprocessed functional run to cut (ending in func_brain.nii.gz)
+    tsv_fpath : string
+        Events file with the onset and duration of each clip
+    cond : string
+        The cond that should be chosen from the sliced data
+    compress : boolean
+        Whether to save gzipped clips (.nii.gz) or uncompressed, memory
+        mappable clips (.nii)
     """
+    import nibabel as nib
+    import pandas as pd
+
     #values reported in the data description
     #start_values = [5, 71, 137, 203, 269, 335]
     #end_values = [64, 130, 196, 262, 328, 394]
 
-    clips = []
     print(fpath)
     df = pd.read_csv(tsv_fpath, engine='python', sep='\t')
-    data = nib.load(fpath)
-    img = data.get_fdata().T[3:] # remove first 3 volumes
+    data = nib.load(fpath, keep_file_open=True)
+    skip = 3 # remove first 3 volumes
 
-    hdr_fpath = fpath
-    hdr = data.get_header()
+    hdr = data.header
     tr = float(hdr.get_zooms()[3]) # temporal resolution of fMRI
 
-    for index, row in df.iterrows():
+    for index, row in df.sort_values('onset', kind='stable').iterrows():
         if cond == 'All' or cond in row['trial_type']:
             start = int((row['onset']/tr))
             end = int(start + (row['duration']/tr))
@@ -417,9 +804,12 @@ def save_clip_nii(fpath, tsv_fpath, cond='All'):
                 abb = ''.join(x[0].upper() for x in row['trial_type'].strip().split(" ")[:2])
             else:
                 abb = row['trial_type'].strip().split(" ")[0][:2].upper()
-            new_fpath = fpath[:-12] + abb + '-0' + str(index+1) + fpath[-7:] # output path
+            ext = fpath[-7:] if compress else '.nii'
+            new_fpath = fpath[:-12] + abb + '-0' + str(index+1) + ext # output path
 
             # save each clip separately
-            new_img = nib.Nifti1Image(img[start:end].T, data.affine, data.header)
+            clip = np.asanyarray(
+                data.dataobj[..., (skip + start):(skip + end)])
+            new_img = nib.Nifti1Image(clip, data.affine, data.header)
             nib.save(new_img, new_fpath)
-            print('Saved ' + new_fpath)
\ No newline at end of file
+            print('Saved ' + new_fpath)
@@ -0,0 +1,99 @@
+import numpy as np
+from data import load_s_light
+from s_light import run_searchlight, HMM_stats, shift_corr_stats
+from utils import get_perms, ev_annot_freq, hrf_convolution
+
+STATS = ['optimal_events', 'AUCdiff', 'peak_shift', 'shift_corr_peak']
+
+
+def s_light_stats(data_list, subjects, nPerm, max_lag, dtype):
+    """Run all analyses in one searchlight in dtype and compute map values
+
+    Parameters
+    ----------
+    data_list : list of ndarrays
+        List of Reps x TRs x Vox arrays for each subject
+    subjects : list
+        List of subject directories
+    nPerm : int
+        Number of permutations, including the real analysis
+    max_lag : int
+        Maximum lag for shift_corr
+    dtype : dtype
+        np.float64 or np.float32
+
+    Returns
+    -------
+    dict
+        Optimal number of events, anticipation, shift in peak lag of
+        correlation with annotations and shift_corr peak, for each
+        permutation
+    """
+
+    perms = get_perms(len(data_list), nPerm)
+    results = run_searchlight([d.astype(dtype) for d in data_list], perms,
+                              subjects, max_lag)
+    AUCdiffs, peak_shift = HMM_stats(results['fit_HMM'].astype(np.float64),
+                                     hrf_convolution(ev_annot_freq()),
+                                     max_lag)
+    return {'optimal_events': results['optimal_events'],
+            'AUCdiff': AUCdiffs,
+            'peak_shift': peak_shift,
+            'shift_corr_peak': shift_corr_stats(results['shift_corr'],
+                                                max_lag)}
+
+
+def validate_float32(store_fpath, subjects, sl_ids, nPerm=3, max_lag=10):
+    """Compare the float32 compute path against float64 on a few searchlights
+
+    Each searchlight is analyzed once with its data in float64 and once in
+    float32 (SRM, HMM fits and shift_corr then all run in float32), and the
+    values that make up the final maps are compared. If the store itself is
+    float32, this measures the precision of the computations only; run it
+    on a float64 store to also include the rounding of the stored data.
+
+    Parameters
+    ----------
+    store_fpath : string
+        Searchlight store written by save_s_lights
+    subjects : list
+        List of subject directories
+    sl_ids : iterable of ints
+        Searchlights to compare
+    nPerm : int
+        Number of permutations, including the real analysis
+    max_lag : int
+        Maximum lag for shift_corr
+
+    Returns
+    -------
+    dict
+        Maximum absolute deviation between float32 and float64 of each
+        statistic: optimal number of events, anticipation in seconds, shift
+        in peak lag of correlation with annotations in seconds, and peak of
+        shift_corr in seconds
+    """
+
+    import tables
+
+    max_dev = dict.fromkeys(STATS, 0.0)
+    h5file = tables.open_file(store_fpath, mode='r')
+    for sl_i in sl_ids:
+        data_list = load_s_light(h5file, sl_i, subjects)
+        stats64 = s_light_stats(data_list, subjects, nPerm, max_lag,
+                                np.float64)
+        stats32 = s_light_stats(data_list, subjects, nPerm, max_lag,
+                                np.float32)
+        for name in STATS:
+            dev = np.abs(np.asarray(stats64[name], dtype=np.float64) -
+                         stats32[name])
+            if np.any(np.isnan(stats64[name]) != np.isnan(stats32[name])):
+                dev = np.inf
+            max_dev[name] = max(max_dev[name], np.nanmax(dev))
+    h5file.close()
+
+    print('float32 vs float64 on %d searchlights, maximum deviation:' %
+          len(sl_ids))
+    for name in STATS:
+        print('   %s: %g' % (name, max_dev[name]))
+    return max_dev